@@ -0,0 +1,139 @@
+// Score history charts of a validator, drawn from the chart data of the chain
+// (see chart_data_scores and chart_data_activity in python/scores_1kv.py).
+
+var SVG_NS = 'http://www.w3.org/2000/svg';
+var WIDTH = 600, HEIGHT = 360;
+var MARGIN = {left: 60, right: 15, top: 35, bottom: 35};
+
+var chartData = {};
+
+function loadChartData(src) {
+  // one request per data file, shared by all charts of the page
+  if (!(src in chartData)) {
+    chartData[src] = fetch(src).then(function(response) {
+      if (!response.ok) {
+        throw new Error(src + ': ' + response.status);
+      }
+      return response.json();
+    });
+  }
+  return chartData[src];
+}
+
+function svgElement(name, attributes) {
+  var element = document.createElementNS(SVG_NS, name);
+  Object.keys(attributes).forEach(function(key) {
+    element.setAttribute(key, attributes[key]);
+  });
+  return element;
+}
+
+function niceTicks(low, high, count) {
+  var step = Math.pow(10, Math.floor(Math.log10((high - low) / count)));
+  [1, 2, 2.5, 5, 10].some(function(factor) {
+    if ((high - low) / (step * factor) <= count) {
+      step = step * factor;
+      return true;
+    }
+    return false;
+  });
+  var ticks = [];
+  for (var tick = Math.ceil(low / step) * step; tick <= high + step * 1e-9; tick += step) {
+    ticks.push(Math.round(tick / step) * step);
+  }
+  return ticks;
+}
+
+// Series of the stash over all eras: values (null before the first update) and the update positions
+function scoreSeries(data, row) {
+  var values = new Array(data.eras.length).fill(null);
+  var updates = [];
+  var last = null;
+  var k = data.start[row];
+  for (var i = 0; i < data.eras.length; i++) {
+    if (k < data.start[row + 1] && data.era[k] === i) {
+      last = data.value[k];
+      updates.push(i);
+      k++;
+    }
+    values[i] = last;
+  }
+  return {values: values, updates: updates};
+}
+
+function activitySeries(data, row) {
+  var values = [];
+  var hex = row >= 0 ? data.bits[row] : '';
+  for (var i = 0; i < data.eras.length; i++) {
+    var digit = i >> 2 < hex.length ? parseInt(hex[i >> 2], 16) : 0;
+    values.push((digit >> (3 - (i & 3))) & 1);
+  }
+  return {values: values, updates: values.map(function(_, i) { return i; })};
+}
+
+function drawChart(container, data, series) {
+  var eras = data.eras;
+  var x0 = eras.length > 0 ? eras[0] : 0, x1 = eras.length > 1 ? eras[eras.length - 1] : x0 + 1;
+  var y0 = data.ylim[0], y1 = data.ylim[1];
+  var sx = function(x) { return MARGIN.left + (x - x0) / (x1 - x0) * (WIDTH - MARGIN.left - MARGIN.right); };
+  var sy = function(y) { return HEIGHT - MARGIN.bottom - (y - y0) / (y1 - y0) * (HEIGHT - MARGIN.top - MARGIN.bottom); };
+
+  var svg = svgElement('svg', {viewBox: '0 0 ' + WIDTH + ' ' + HEIGHT, width: '100%', role: 'img', 'font-size': 13});
+  var title = svgElement('text', {x: WIDTH / 2, y: 20, 'text-anchor': 'middle', 'font-size': 15});
+  title.textContent = data.title;
+  svg.appendChild(title);
+
+  // grid and ticks
+  (data.yticks || niceTicks(y0, y1, 5)).forEach(function(tick) {
+    svg.appendChild(svgElement('line', {x1: MARGIN.left, x2: WIDTH - MARGIN.right, y1: sy(tick), y2: sy(tick), stroke: '#ddd'}));
+    var label = svgElement('text', {x: MARGIN.left - 6, y: sy(tick) + 4, 'text-anchor': 'end'});
+    label.textContent = tick;
+    svg.appendChild(label);
+  });
+  niceTicks(x0, x1, 6).forEach(function(tick) {
+    svg.appendChild(svgElement('line', {x1: sx(tick), x2: sx(tick), y1: MARGIN.top, y2: HEIGHT - MARGIN.bottom, stroke: '#ddd'}));
+    var label = svgElement('text', {x: sx(tick), y: HEIGHT - MARGIN.bottom + 18, 'text-anchor': 'middle'});
+    label.textContent = tick;
+    svg.appendChild(label);
+  });
+  svg.appendChild(svgElement('rect', {x: MARGIN.left, y: MARGIN.top, width: WIDTH - MARGIN.left - MARGIN.right,
+    height: HEIGHT - MARGIN.top - MARGIN.bottom, fill: 'none', stroke: '#888'}));
+  if (data.ylabel) {
+    var ylabel = svgElement('text', {transform: 'translate(14,' + HEIGHT / 2 + ') rotate(-90)', 'text-anchor': 'middle', 'font-size': 11});
+    ylabel.textContent = data.ylabel;
+    svg.appendChild(ylabel);
+  }
+
+  // line (no line before the first value) and a dot per update
+  var points = [];
+  series.values.forEach(function(value, i) {
+    if (value !== null) {
+      points.push(sx(eras[i]).toFixed(1) + ',' + sy(value).toFixed(1));
+    }
+  });
+  svg.appendChild(svgElement('polyline', {points: points.join(' '), fill: 'none', stroke: 'blue', 'stroke-width': 1.5}));
+  series.updates.forEach(function(i) {
+    var dot = svgElement('circle', {cx: sx(eras[i]), cy: sy(series.values[i]), r: 3, fill: 'blue'});
+    var tooltip = svgElement('title', {});
+    tooltip.textContent = 'Era ' + eras[i] + ': ' + series.values[i];
+    dot.appendChild(tooltip);
+    svg.appendChild(dot);
+  });
+
+  container.replaceChildren(svg);
+}
+
+document.querySelectorAll('.score-chart').forEach(function(container) {
+  loadChartData(container.dataset.src).then(function(data) {
+    var row = data.stashes.indexOf(container.dataset.stash);
+    if (data.bits) {
+      drawChart(container, data, activitySeries(data, row));
+    } else if (row >= 0) {
+      drawChart(container, data, scoreSeries(data, row));
+    } else {
+      container.textContent = data.title + ': no data for this validator.';
+    }
+  }).catch(function(error) {
+    container.textContent = 'Chart not available (' + error.message + ').';
+  });
+});
@@ -3,7 +3,6 @@
 # Copyright 2022-23 https://www.math-crypto.com -- GNU General Public License
 
 # pip3 install substrate-interface
-from substrateinterface import SubstrateInterface
 from substrateinterface.exceptions import SubstrateRequestException
 import sys
 import pandas as pd
@@ -12,8 +11,19 @@ from pathlib import Path
 import logging
 import time
 import random
+from rpc_fetch import get_era_reward_points, get_active_validators, RpcError
+from substrate_pool import rpc_url, get_substrate, query_active_era
+from pipeline_events import emit_event
+from activity_matrix import read_activity, write_activity, append_activity, activity_from_frame
 
 PATH_ONCHAIN = Path.cwd() / "../onchain"
+NB_ACTIVITY_ERAS = 200
+
+# Options of the concurrent era fetcher (see rpc_fetch.AsyncRpcClient)
+RPC_OPTIONS = {"max_in_flight": 8,  # requests waiting for an answer
+               "rate_limit": 10.0,  # requests per sec
+               "retries": 5,        # with exponential backoff starting at 'backoff' sec
+               "backoff": 1.0}
 
 def get_on_chain_era_points(chain):
     """
@@ -23,20 +33,13 @@ def get_on_chain_era_points(chain):
     If the API complains about too many requests, we can also fetch only the new eras based on 
     what is in "on_chain_era_points.feather".
     """
-    # TODO put in .env
-    if chain=='kusama':
-        url = "wss://rpc.ibp.network/kusama"
-    elif chain=='polkadot':    
-        url = "wss://rpc.ibp.network/polkadot"
-
+    url = rpc_url(chain)
     try:
-        substrate = SubstrateInterface(url=url)
+        substrate = get_substrate(chain)
     except ConnectionRefusedError:
         sys.exit("⚠️ Remote RPC server didn't respond")
 
-    result = substrate.query(module='Staking', storage_function='ActiveEra')
-    cur_era = result['index'].decode()
-    cur_time = result['start'].decode()
+    cur_era, cur_time = query_active_era(chain)
 
     era_start_file = PATH_ONCHAIN / chain / "on_chain_era_start.feather"
     if Path.exists(era_start_file):
@@ -48,30 +51,8 @@ def get_on_chain_era_points(chain):
         df_start = pd.DataFrame({"era": [cur_era], "start": [cur_time]})    
         df_start.to_feather(era_start_file)
            
-    dfs = []    
-    era = cur_era    
-    logging.info(f"Fetch started from era {era}. Should be finished in < 1 min.")
-    while True:        
-        result = substrate.query(module='Staking', storage_function='ErasRewardPoints', params=[era])
-        if result['total'] == 0:
-            if era == cur_era:  # The current era might now have started yet?          
-                era = era - 1            
-            else:
-                start_era = era+1
-                logging.info(f"Fetch ended at era {era}")
-                break
-                
-        else:            
-            new_list = []
-            for i in result['individual']:
-                new_list.append([i[0].decode(), i[1].decode()])
-            
-            df_i = pd.DataFrame.from_records(new_list, columns=['address', 'points'])
-            df_i['era'] = era
-            dfs.append(df_i)
-            era = era - 1        
-
-    df_pts = pd.concat(dfs).reset_index(drop=True)
+    logging.info(f"Fetch started from era {cur_era}. Should be finished in < 1 min.")
+    df_pts = get_era_reward_points(url, substrate, cur_era, **RPC_OPTIONS)
 
     start_era = np.min(df_pts['era'])
     end_era = np.max(df_pts['era'])
@@ -81,95 +62,41 @@ def get_on_chain_era_points(chain):
 
 
 def get_on_chain_activity(chain):
-    if chain == 'kusama':
-        url = "wss://rpc.ibp.network/kusama"
-    elif chain == 'polkadot':
-        url = "wss://rpc.ibp.network/polkadot"
-    else:
-        raise ValueError("Unsupported chain. Use 'polkadot' or 'kusama'.")
+    url = rpc_url(chain)
+    substrate = get_substrate(chain)
 
-    # Define the WebSocket endpoint
-    substrate = SubstrateInterface(
-        url=url,
-        type_registry_preset=chain
-    )
-
-    # Path to the Feather file
+    # Activity store (see activity_matrix.py), converted once from the old feather file
+    activity_dir = PATH_ONCHAIN / chain / 'eras_activity'
     feather_path = PATH_ONCHAIN / chain / 'eras_activity.feather'
-    feather_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # Read existing data
-    if feather_path.exists():
+    if not activity_dir.exists() and feather_path.exists():
         df_existing = pd.read_feather(feather_path)
-        if 'index' not in df_existing.columns:
-            df_existing = pd.DataFrame(columns=['index'])
-        else:
-            existing_eras = df_existing.columns[1:].astype(str).tolist()
-            df_existing.set_index('index', inplace=True)
-    else:
-        df_existing = pd.DataFrame(columns=['index'])
-        existing_eras = []
+        if 'index' in df_existing.columns:
+            write_activity(activity_dir, *activity_from_frame(df_existing))
+
+    # Read existing eras
+    _, _, existing_eras = read_activity(activity_dir)
 
     try:
         # Fetch the active era
-        active_era = substrate.query(
-            module='Staking',
-            storage_function='ActiveEra'
-        ).value['index']
+        active_era, _ = query_active_era(chain)
 
-        # Define the range of eras to check (last 200 eras)
-        eras_to_check = list(range(active_era - 200, active_era+1))
+        # Define the range of eras to check (the active era and the 200 eras before it)
+        eras_to_check = list(range(active_era - NB_ACTIVITY_ERAS, active_era+1))
 
         # Eras that need to be fetched
-        missing_eras = [era for era in eras_to_check if str(era) not in existing_eras]
+        missing_eras = [era for era in eras_to_check if era not in existing_eras]
 
         if not missing_eras:
             print("No new eras to fetch.")
             return
 
-        # Initialize a set to collect all unique validator addresses
-        validators_set = set()
-
-        # Dictionary to hold the activity data
-        activity_data = {era: {} for era in missing_eras}
-
-        for era in missing_eras:
-            # Fetch the era stakers overview for the given era
-            era_stakers_overview = substrate.query_map(
-                module='Staking',
-                storage_function='ErasStakersOverview',
-                params=[era]
-            )
-
-            # Collect active validators in this era
-            for record in era_stakers_overview:
-                validator = record[0].value
-                validators_set.add(validator)
-                activity_data[era][validator] = 1
-
-        # Create a DataFrame to store the new activity data
-        validators_list = sorted(validators_set.union(df_existing.index))
-        df_new = pd.DataFrame(index=validators_list, columns=[str(era) for era in missing_eras]).fillna(0)
-
-        # Update the DataFrame with the actual activity data
-        for era, validators in activity_data.items():
-            for validator, active in validators.items():
-                df_new.at[validator, str(era)] = active
-
-        # Combine with existing data
-        df_combined = pd.concat([df_existing, df_new], axis=1).fillna(0)
-
-        # Keep only the last 200 eras
-        if len(df_combined.columns) > 200:
-            df_combined = df_combined.iloc[:, -200:]
-
-        # Save to Feather file
-        df_combined.reset_index(inplace=True)
-        df_combined.to_feather(feather_path)
+        # Fetch the era stakers overview for all missing eras concurrently
+        active_validators = get_active_validators(url, substrate, missing_eras, **RPC_OPTIONS)
 
-        # Print the resulting DataFrame
+        # Add to the activity matrix and keep the eras that are checked, so the oldest one is not fetched again
+        append_activity(activity_dir, active_validators, window=NB_ACTIVITY_ERAS + 1)
 
-    except SubstrateRequestException as e:
+    except (SubstrateRequestException, RpcError) as e:
         print(f"An error occurred: {e}")
 
 
@@ -211,11 +138,13 @@ def main_loop():
         get_on_chain_activity('kusama')
         time.sleep((5.0+random.random())*2)
         get_on_chain_era_points('kusama')                
+        emit_event("score", "kusama", "onchain")
         time.sleep((5.0+random.random())*2)
 
         get_on_chain_activity('polkadot')
         time.sleep((5.0+random.random())*2)
         get_on_chain_era_points('polkadot')
+        emit_event("score", "polkadot", "onchain")
         time.sleep((5.0+random.random())*2)
         
         time.sleep(4*60*60.0 + (5.0+random.random())*2) # every 4h
@@ -0,0 +1,101 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Compact store of the validator x era activity (active set membership) fetched by active_eras.py.
+
+The store is a directory with three .npy files:
+    activity.npy  -- uint8 matrix (stash x era), 1 if the stash was in the active set
+    stashes.npy   -- the stash addresses of the rows (fixed width unicode)
+    eras.npy      -- the era (int64) of the columns, increasing
+
+All files are read memory mapped, so a row of a validator can be used without copying.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+ACTIVITY_FILE = "activity.npy"
+STASHES_FILE = "stashes.npy"
+ERAS_FILE = "eras.npy"
+
+
+def _save_atomic(path, array):
+    tmp = path.with_name(path.name + ".tmp.npy")
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def read_activity(activity_dir, mmap=True):
+    """
+    Read the activity store. Returns (activity, stashes, eras) with stashes a pd.Index.
+
+    If the store does not exist yet, an empty matrix is returned.
+    """
+    if not (activity_dir / ACTIVITY_FILE).exists():
+        return np.zeros((0, 0), dtype=np.uint8), pd.Index([], dtype=object), np.zeros(0, dtype=np.int64)
+    mmap_mode = "r" if mmap else None
+    activity = np.load(activity_dir / ACTIVITY_FILE, mmap_mode=mmap_mode)
+    stashes = pd.Index(np.load(activity_dir / STASHES_FILE).astype(object))
+    eras = np.load(activity_dir / ERAS_FILE)
+    if activity.shape != (len(stashes), len(eras)):
+        raise ValueError(f"Inconsistent activity store in {activity_dir}: {activity.shape} vs {len(stashes)} stashes and {len(eras)} eras.")
+    return activity, stashes, eras
+
+
+def write_activity(activity_dir, activity, stashes, eras):
+    activity_dir.mkdir(parents=True, exist_ok=True)
+    # The index files first: a reader detects a mismatch until the matrix is replaced as well
+    _save_atomic(activity_dir / STASHES_FILE, np.asarray(stashes, dtype=str))
+    _save_atomic(activity_dir / ERAS_FILE, np.asarray(eras, dtype=np.int64))
+    _save_atomic(activity_dir / ACTIVITY_FILE, np.ascontiguousarray(activity, dtype=np.uint8))
+
+
+def append_activity(activity_dir, active_validators, window=200):
+    """
+    Add new eras to the store. active_validators is a dict era -> list of active stashes.
+
+    Only the last window eras are kept and stashes without any activity in that window are dropped.
+    """
+    activity, stashes, eras = read_activity(activity_dir, mmap=False)
+
+    new_eras = np.array(sorted(active_validators), dtype=np.int64)
+    all_eras = np.union1d(eras, new_eras)
+    all_eras = all_eras[all_eras > all_eras.max() - window]
+    new_stashes = pd.Index(sorted(set().union(*active_validators.values())))
+    all_stashes = stashes.append(new_stashes.difference(stashes))
+
+    # old columns and rows keep their values, the new ones are filled in per era with one fancy index
+    matrix = np.zeros((len(all_stashes), len(all_eras)), dtype=np.uint8)
+    old_cols = np.searchsorted(all_eras, eras)
+    old_keep = (old_cols < len(all_eras)) & (all_eras[np.minimum(old_cols, len(all_eras) - 1)] == eras)
+    matrix[:len(stashes), old_cols[old_keep]] = activity[:, old_keep]
+    for era, validators in active_validators.items():
+        col = np.searchsorted(all_eras, era)
+        if col < len(all_eras) and all_eras[col] == era:
+            matrix[:, col] = 0
+            matrix[all_stashes.get_indexer(list(validators)), col] = 1
+
+    active_rows = matrix.any(axis=1)
+    write_activity(activity_dir, matrix[active_rows], all_stashes[active_rows], all_eras)
+    return matrix[active_rows], all_stashes[active_rows], all_eras
+
+
+def activity_from_frame(df_activity):
+    """
+    Convert the old eras_activity.feather dataframe (column 'index' with the stashes and a column per era)
+    to (activity, stashes, eras).
+    """
+    df = df_activity.set_index("index")
+    eras = np.array([int(col) for col in df.columns], dtype=np.int64)
+    order = np.argsort(eras)
+    activity = df.to_numpy(dtype=float)[:, order].astype(np.uint8)
+    return activity, pd.Index(df.index.astype(str)), eras[order]
+
+
+def activity_to_frame(activity, stashes, eras):
+    """
+    Wide dataframe as in the old eras_activity.feather, useful in notebooks.
+    """
+    df = pd.DataFrame(np.asarray(activity), index=stashes, columns=[str(era) for era in eras])
+    return df.rename_axis("index").reset_index()
@@ -10,16 +10,20 @@ import random
 from pathlib import Path
 import time
 import logging
+from snapshots_1kv import latest_snapshot_datetime, write_snapshot
+from pipeline_events import emit_event
 
 TIME_DELTA_SEC = 1*60*60 # 1 hour
+# Delta mode: only store the rows and columns that changed w.r.t. the previous dump,
+# with a full snapshot (keyframe) every KEYFRAME_EVERY dumps.
+DELTA_MODE = False
+KEYFRAME_EVERY = 24
 PATH_JSON  = Path.cwd() / "../1kv_json"
 
 def dump(url, feather_path):    
-    files = list(feather_path.glob("*.feather"))
+    latest_time = latest_snapshot_datetime(feather_path)
 
-    if files:
-        latest_file = max([f for f in files], key=lambda item: item.stat().st_ctime)
-        latest_time = int(latest_file.stem)
+    if latest_time is not None:
         delta = time.time() - latest_time
         print(delta)
         if(delta < TIME_DELTA_SEC):
@@ -44,8 +48,9 @@ def dump(url, feather_path):
     # df['openGovDelegations.track'] = df['openGovDelegations.track'].astype('str')
     
     cur_time = int(time.time())
-    file_name = str(cur_time) + ".feather"
-    df.to_feather(feather_path / file_name)
+    write_snapshot(feather_path, cur_time, df, delta=DELTA_MODE, keyframe_every=KEYFRAME_EVERY)
+    # the directory name is the chain; triggers make_score_figures.py
+    emit_event("score", feather_path.name, "dump")
         
     logging.info("Wrote JSON")        
 
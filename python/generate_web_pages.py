@@ -4,7 +4,7 @@
 
 from distutils.dir_util import remove_tree
 from pathlib import Path
-from shutil import copy, copytree, rmtree
+from shutil import copy, copy2, copytree, rmtree
 
 import pandas as pd
 import logging
@@ -12,14 +12,22 @@ import time
 import random
 import json
 import pickle
-import fileinput
+import hashlib
+import html
+import re
 from datetime import datetime, timezone
 import glob
 import os
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from scores_1kv import *
+from pipeline_events import wait_for_events
+from page_template import PageTemplate
+from publish import index_files, publish_file, publish_tree
+from upload import upload, LocalDirDestination, RcloneDestination
 import timeit
 
 
@@ -34,92 +42,342 @@ PATH_DOKS_ROOT = Path.cwd() / "../doks"
 
 
 
-def generate(chain):
-    logging.info(f"Generating new pages for the stashes of {chain}.")
+# "hugo": the stash pages are markdown pages built by Hugo. "html": the stash pages are rendered to html
+# here, in a layout taken from a page built by Hugo (see extract_page_layout), and added to the built
+# site; Hugo then only builds the hand-written part of the site.
+PAGE_MODE = "hugo"
+# The page of each chain that Hugo builds with placeholders, to extract the layout from
+LAYOUT_PAGE = "page-layout"
+LAYOUT_PLACEHOLDERS = ["$PAGE-TITLE$", "$PAGE-STASH$", "$PAGE-CONTENT$"]
+# The root of the site in the html templates (e.g. of the chart data), taken from the layout (see page_root)
+ROOT_PLACEHOLDER = "$PAGE-ROOT$"
+
+# The rclone remote of the website (configured before), or a local directory with UPLOAD_LOCAL_DIR
+UPLOAD_REMOTE = "InsightWebsite:./"
+UPLOAD_LOCAL_DIR = None
+UPLOAD_TRANSFERS = 16
+
+# The stash pages are written by a process pool of CPU_BUDGET workers, in shards of at least MIN_PAGE_BATCH pages
+CPU_BUDGET = os.cpu_count() or 4
+MIN_PAGE_BATCH = 50
+
+# Placeholders of the header of the stash pages: column in last_info_1kv -> placeholder
+HEADER_PLACEHOLDERS = {"stash": "STASH",
+                       "name": "$TELEMETRY-NAME$" ,
+                       "commission": "$COMMISSION$",
+                       "rank": "$RANK$",
+                       "faults": "$NB-FAULTS$",
+                       "valid": "$VALID$"}
+DATE_PLACEHOLDERS = {"$DUMP_DATE_TIME$": "dump.datetime",
+                     "$SCORE_DATE_TIME$": "score.datetime"}
+ANGEL_PLACEHOLDERS = ["$ANGEL_LOCATION_VALUE$", "$ANGEL_LOCATION_SCORE$", "$ANGEL_LOCATION_TH_SCORE$", "$ANGEL_DELAY_SCORE$"]
+
+
+def score_placeholders(chain):
+    """
+    Placeholders of the individual scores, eg '$inclusion$': 'score.inclusion'
+    """
+    return {f"${v.split('.')[-1]}$" : v  for v in list(descr_scores[chain].keys())}
+
+
+def stash_page_placeholders(chain):
+    return ["DATETIME"] + list(HEADER_PLACEHOLDERS.values()) + list(score_placeholders(chain)) + list(DATE_PLACEHOLDERS) + ANGEL_PLACEHOLDERS
+
+
+def format_page_datetime(dt):
+    return dt.strftime("%B %d, %Y at %I:%M:%S %p UTC").replace(' at 0', ' at ')
+
+
+def stash_page_values(chain, row, latest_dump):
+    """
+    The values of all placeholders of the page of the stash in row (of last_info_1kv).
+
+    Values that change with every dump (and not with the data of the stash) are taken from the shared 
+    page data of the chain by shortcodes (see write_page_data), so the page only changes when its data does.
+    For a stash that is not in the latest dump (latest_dump), they are filled in as before.
+    """
+    # The page date is the time of the score. Hugo wants the time in UTC if no offset.
+    values = {"DATETIME": row["score.datetime"].tz_localize(timezone.utc).isoformat()}
+    for key, placeholder in HEADER_PLACEHOLDERS.items():
+        values[placeholder] = f"{row[key]}"
+    for placeholder, field in score_placeholders(chain).items():
+        if field=="score.randomness":
+            score_str = f"{row[field]:.2f}" 
+            max_str = f"{bound_scores[chain][field][1]:.2f}"
+        else:
+            score_str = f"{row[field]:.1f}" 
+            max_str = f"{bound_scores[chain][field][1]:.0f}"
+        values[placeholder] = f"{score_str}/{max_str}"
+    # Score retrieved from 1kv backend on $DUMP_DATE_TIME$. Score last calculated by backend on $SCORE_DATE_TIME$.
+    for placeholder, field in DATE_PLACEHOLDERS.items():
+        values[placeholder] = format_page_datetime(row[field])
+    # the 1kv angel
+    diff = pd.to_timedelta(row["dump.datetime"] - row["score.datetime"])
+    values["$ANGEL_LOCATION_VALUE$"] = f"{row['location']} (occurs {row['location.count']:.0f} times)"
+    values["$ANGEL_LOCATION_SCORE$"] = f"{row['score.location']:.1f}"
+    values["$ANGEL_LOCATION_TH_SCORE$"] = f"{row['th-score.location']:.1f}"
+    values["$ANGEL_DELAY_SCORE$"] = format_time_delta(diff)
+    if row["dump.datetime"] == latest_dump:
+        values["$DUMP_DATE_TIME$"] = '{{< page-data "dump" >}}'
+        values["$ANGEL_DELAY_SCORE$"] = f'{{{{< score-age "{values["DATETIME"]}" >}}}}'
+    return values
+
+
+def write_page_data(chain, latest_dump):
+    """
+    Data shared by all stash pages of the chain, copied to doks/data/<chain>/pages.json by copy_to_website:
+    the time of generation and of the latest dump.
+    """
+    data = {"generated": datetime.now(timezone.utc).isoformat(),
+            "dump": format_page_datetime(latest_dump),
+            "dump_iso": latest_dump.tz_localize(timezone.utc).isoformat()}
+    with open(PATH_INFO / chain / "pages.json", "w") as f:
+        json.dump(data, f)
+
+
+# Change when the pages change in a way that the manifest does not see (e.g. generate itself)
+PAGE_VERSION = 1
+
+def stash_page_hashes(template_file, values_list, figure_hashes, layout_file=None):
+    """
+    Hash of everything a stash page depends on: the page version, the template (and layout), the placeholder 
+    values and the hashes of its figures (from the render caches). Returns a dict stash -> hash.
+    """
+    base = hashlib.blake2b(f"{PAGE_VERSION}".encode(), digest_size=16)
+    base.update(template_file.read_bytes())
+    if layout_file is not None:
+        base.update(layout_file.read_bytes())
+    hashes = {}
+    for values in values_list:
+        stash = values["STASH"]
+        h = base.copy()
+        h.update(json.dumps(values, sort_keys=True).encode())
+        h.update(json.dumps(figure_hashes.get(stash, {}), sort_keys=True).encode())
+        hashes[stash] = h.hexdigest()
+    return hashes
+
+
+def plan_stash_pages(chain, layout=None):
+    """
+    Find the pages of the stashes whose inputs changed since the last run (see stash_page_hashes and the 
+    manifest tmp/<chain>/pages_manifest.json). Returns a dict with the template, the values and figures of 
+    the pages to write (todo) and what finish_stash_pages needs.
+
+    With the layout of extract_page_layout, the pages are html (PAGE_MODE "html").
+    """
     last_1kv = pd.read_feather(PATH_INFO / chain / "last_info_1kv.feather")
-    for index, row in last_1kv.iterrows():        
-        addr = row["stash"]
-        
-        logging.debug(f"   {addr}")
+    # in data mode the page draws the charts in the browser from the chart data of the chain
+    template_name = "index_charts" if FIGURE_MODE == "data" else "index"
+    template_name += ".md" if layout is None else ".html"
+    template_file = PATH_WEB / "templates" / chain / template_name
+    # parsed (and checked) once, each page is then rendered in memory and written at once
+    placeholders = stash_page_placeholders(chain) + ([ROOT_PLACEHOLDER] if layout is not None else [])
+    template = PageTemplate.from_file(template_file, placeholders)
+    latest_dump = last_1kv["dump.datetime"].max()
+    write_page_data(chain, latest_dump)
+
+    path_new_figs = PATH_NEWFIGS / chain
+    # listed once: address -> its figures
+    figure_index = index_files(path_new_figs) if FIGURE_MODE != "data" else {}
+    figure_hashes = {}
+    if FIGURE_MODE != "data":
+        for cache_file in ["render_cache_scores.json", "render_cache_activity.json"]:
+            for addr, hashes in read_render_cache(path_new_figs / cache_file).items():
+                figure_hashes.setdefault(addr, {}).update(hashes)
+
+    if layout is None:
+        values_list = [stash_page_values(chain, row, latest_dump) for row in last_1kv.to_dict("records")]
+        page_file = "index.md"
+        page_hashes = stash_page_hashes(template_file, values_list, figure_hashes)
+    else:
+        # no shortcodes in html: all values are filled in, and escaped
+        root = page_root(chain)
+        values_list = [{key: html.escape(value) for key, value in stash_page_values(chain, row, None).items()} 
+                       | {ROOT_PLACEHOLDER: root} for row in last_1kv.to_dict("records")]
+        page_file = "index.html"
+        page_hashes = stash_page_hashes(template_file, values_list, figure_hashes, layout_file=PATH_TMP / chain / "page_layout.html")
+    manifest_file = PATH_TMP / chain / "pages_manifest.json"
+    manifest = {}
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    todo = [(values, figure_index.get(values["STASH"], [])) for values in values_list 
+            if manifest.get(values["STASH"]) != page_hashes[values["STASH"]] 
+               or not (PATH_WEB / chain / values["STASH"] / page_file).exists()]
+    return {"chain": chain, "template": template, "layout": layout, "page_file": page_file, "todo": todo,
+            "page_hashes": page_hashes, "manifest": manifest, "manifest_file": manifest_file}
+
+
+def write_stash_pages(chain, template, layout, page_file, todo):
+    """
+    Write the pages (and link the figures) of todo, a list of (values, figure paths). Runs in the workers 
+    of generate_chains, so it does not log: returns the addresses of the pages written, in order.
+    """
+    written = []
+    for values, figures in todo:
+        addr = values["STASH"]
         addr_path_web = PATH_WEB / chain / addr
         addr_path_web.mkdir(exist_ok=True)
-        file_template = PATH_WEB / "templates" / chain  / "index.md"
-        addr_file_index = addr_path_web / "index.md"
-        copy(file_template, addr_file_index)
-
-        # Do simple subs
-        # with fileinput.FileInput(addr_file_index, inplace=True) as file:
-        #     for line in file:
-        #         print(line.replace("STASH", addr), end='')
-        with fileinput.FileInput(addr_file_index, inplace=True) as file:
-            for line in file:
-                # Hugo wants the time in UTC if no offset.
-                print(line.replace("DATETIME", f"{datetime.now(timezone.utc).isoformat()}"), end='')
-        # Subs for header
-        subs = {"stash": "STASH",
-          "name": "$TELEMETRY-NAME$" ,
-          "commission": "$COMMISSION$",
-          "rank": "$RANK$",
-          "faults": "$NB-FAULTS$",
-          "valid": "$VALID$"}     
-        sys.stdout.reconfigure(encoding='utf-8')
-        for key, value in subs.items():
-            with fileinput.FileInput(addr_file_index, inplace=True, encoding='utf-8') as file:
-                for line in file:
-                    print(line.replace(value, f"{row[key]}"), end='')
-        # Subs for Individual scores: statistics eg '$inclusion$': 'score.inclusion'
-        subs = {f"${v.split('.')[-1]}$" : v  for v in list(descr_scores[chain].keys())}
-        for key, value in subs.items():   
-            if value=="score.randomness":
-                score_str = f"{row[value]:.2f}" 
-                max_str = f"{bound_scores[chain][value][1]:.2f}"
-            else:
-                score_str = f"{row[value]:.1f}" 
-                max_str = f"{bound_scores[chain][value][1]:.0f}"
-                                
-            with fileinput.FileInput(addr_file_index, inplace=True, encoding='utf-8') as file:
-                for line in file:           
-                    print(line.replace(key, f"{score_str}/{max_str}"), end='')
-        
-        # Subs for Score retrieved from 1kv backend on $DUMP_DATETIME$. Score last calculated by backend on $SCORE_DATETIME$.
-        ### DO NOT USE "DATETIME" SINCE USED ABOVE. INSTEAD USE "DATE_TIME"
-        print( row["score.datetime"])
+        if layout is None:
+            template.write(addr_path_web / page_file, values)
+        else:
+            layout.write(addr_path_web / page_file, {"$PAGE-TITLE$": values["$TELEMETRY-NAME$"], "$PAGE-STASH$": addr, 
+                                                     "$PAGE-CONTENT$": template.render(values)})
+        # link (or copy) the figures
+        for f in figures:
+            publish_file(f, addr_path_web / f.name)
+        written.append(addr)
+    return written
+
+
+def finish_stash_pages(plan, written):
+    """
+    Log the pages written and save the manifest with their hashes.
+    """
+    for addr in written:
+        logging.debug(f"   {addr}")
+    manifest = plan["manifest"]
+    manifest.update({addr: plan["page_hashes"][addr] for addr in written})
+    tmp = plan["manifest_file"].with_name(plan["manifest_file"].name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, plan["manifest_file"])
 
-        
-        subs = {
-        "$DUMP_DATE_TIME$": row["dump.datetime"].strftime("%B %d, %Y at %I:%M:%S %p UTC").replace(' at 0', ' at '),
-        "$SCORE_DATE_TIME$": row["score.datetime"].strftime("%B %d, %Y at %I:%M:%S %p UTC").replace(' at 0', ' at ')
-        }
-
-        for key, value in subs.items():   
-            with fileinput.FileInput(addr_file_index, inplace=True, encoding='utf-8') as file:
-                for line in file:
-                    print(line.replace(key, value), end='')
-
-        # Subs for the 1kv angel
-        diff = pd.to_timedelta(row["dump.datetime"] - row["score.datetime"])
-        
-        subs = {"$ANGEL_LOCATION_VALUE$": f"{row['location']} (occurs {row['location.count']:.0f} times)" ,        
-          "$ANGEL_LOCATION_SCORE$": f"{row['score.location']:.1f}" ,
-          "$ANGEL_LOCATION_TH_SCORE$": f"{row['th-score.location']:.1f}",
-          "$ANGEL_DELAY_SCORE$": format_time_delta(diff)}
-        for key, value in subs.items():   
-            with fileinput.FileInput(addr_file_index, inplace=True, encoding='utf-8') as file:
-                for line in file:
-                    print(line.replace(key, value), end='')
-        
-        # key = "commission"
-        # value = subs[key]
-        # with fileinput.FileInput(addr_file_index, inplace=True) as file:
-        #     for line in file:
-        #         print(line.replace(value, f"{row[key]}"), end='')
-
-            
-        # copy figures
-        path_new_figs = PATH_NEWFIGS / chain
-        for f in path_new_figs.glob(f"{addr}_*.png"):
-            copy(f, addr_path_web)
-    logging.info("   Generating new pages done.")
+
+def page_shards(n_pages, n_jobs, min_batch=MIN_PAGE_BATCH, tasks_per_job=4):
+    """
+    Split the positions of n_pages pages into shards for the workers: a few per worker, none smaller than min_batch.
+    """
+    n_shards = max(1, min(n_jobs * tasks_per_job, n_pages // min_batch))
+    bounds = [round(i * n_pages / n_shards) for i in range(n_shards + 1)]
+    return [range(bounds[i], bounds[i + 1]) for i in range(n_shards) if bounds[i] < bounds[i + 1]]
+
+
+def generate_chains(chains, layouts=None, pool=None, n_jobs=CPU_BUDGET, angel=False):
+    """
+    Generate the pages of the stashes of all chains. The pages are written by shards of stashes in the 
+    process pool of n_jobs workers (all chains at once), or here without pool. With angel, the angel pages 
+    are made here meanwhile. Only this process logs, chain by chain in the order of chains, so the log does 
+    not depend on the order in which the workers finish.
+
+    Returns False if the pool is broken (a worker died): the shards it did not write are then written here,
+    and the pool has to be replaced.
+    """
+    t1 = time.time()
+    layouts = layouts or {}
+    plans = []
+    for chain in chains:
+        logging.info(f"Generating new pages for the stashes of {chain}.")
+        plans.append(plan_stash_pages(chain, layouts.get(chain)))
+
+    shards = [(plan, (plan["chain"], plan["template"], plan["layout"], plan["page_file"], [plan["todo"][i] for i in shard]))
+              for plan in plans for shard in page_shards(len(plan["todo"]), n_jobs if pool is not None else 1)]
+    pool_ok = pool is not None
+    futures = []
+    for plan, args in shards:
+        future = None
+        if pool_ok:
+            try:
+                future = pool.submit(write_stash_pages, *args)
+            except BrokenProcessPool:
+                pool_ok = False
+        futures.append(future)
+    if angel:
+        for chain in chains:
+            generate_angel_pages(chain)
+
+    written = {plan["chain"]: [] for plan in plans}
+    for (plan, args), future in zip(shards, futures):
+        result = None
+        if future is not None:
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                pool_ok = False
+        if result is None:
+            # no pool, or the pool broke: written here (writing a page again is harmless)
+            result = write_stash_pages(*args)
+        written[plan["chain"]] += result
+    if pool is not None and not pool_ok:
+        logging.info("   The worker pool is broken, pages written without it.")
+
+    for plan in plans:
+        finish_stash_pages(plan, written[plan["chain"]])
+        logging.info(f"   Generated {len(written[plan['chain']])} new or changed pages (of {len(plan['page_hashes'])}) for {plan['chain']}.")
+    logging.info(f"   Generating the pages of {', '.join(chains)} done in {time.time()-t1:.1f} sec.")
+    return pool is None or pool_ok
+
+
+def generate(chain, layout=None, pool=None, n_jobs=CPU_BUDGET):
+    """
+    Generate the pages of the stashes of chain (see generate_chains).
+    """
+    return generate_chains([chain], {chain: layout}, pool, n_jobs)
+
+
+def write_layout_page(chain):
+    """
+    Add the page to the doks content from which extract_page_layout takes the layout of the html stash pages.
+    """
+    page_dir = PATH_DOKS_ROOT / "content/en" / chain / LAYOUT_PAGE
+    page_dir.mkdir(parents=True, exist_ok=True)
+    # rendered, but not in the sitemap, the section list nor the search index (.Site.RegularPages)
+    text = ('---\ntitle: "$PAGE-TITLE$"\ndraft: false\nstash: ""\nsitemap:\n  disable: true\n'
+            '_build:\n  list: never\n---\n\n$PAGE-CONTENT$\n\n{{< site-root >}}\n')
+    if FIGURE_MODE == "data":
+        text += '\n{{< score-chart-script >}}\n'
+    page_file = page_dir / "index.md"
+    if not page_file.exists() or page_file.read_text(encoding="utf-8") != text:
+        page_file.write_text(text, encoding="utf-8")
+
+
+def extract_page_layout(chain):
+    """
+    The layout of the html stash pages: the page of write_layout_page as built by Hugo (theme, menus, 
+    scripts) with its title, url and content as placeholders. It is saved in tmp/<chain>/page_layout.html
+    and the page itself is removed from the built site.
+    """
+    built_dir = PATH_DOKS_ROOT / "public" / chain / LAYOUT_PAGE
+    text = (built_dir / "index.html").read_text(encoding="utf-8")
+    text = text.replace("<p>$PAGE-CONTENT$</p>", "$PAGE-CONTENT$").replace(f"/{chain}/{LAYOUT_PAGE}/", f"/{chain}/$PAGE-STASH$/")
+    if "$PAGE-CONTENT$" not in text:
+        raise ValueError(f"No content placeholder in the layout page {built_dir / 'index.html'}")
+    layout_file = PATH_TMP / chain / "page_layout.html"
+    # only replaced if the layout changed, as its contents are part of the page hashes
+    if not layout_file.exists() or layout_file.read_text(encoding="utf-8") != text:
+        layout_file.write_text(text, encoding="utf-8")
+    rmtree(built_dir)
+    return PageTemplate.from_file(layout_file, LAYOUT_PLACEHOLDERS, strict=False)
+
+
+def page_root(chain):
+    """
+    The root of the site (e.g. / or /sub/ for a baseURL with a path) as resolved by Hugo with relURL in the 
+    layout of extract_page_layout (site-root shortcode), for the paths in the html stash pages.
+    """
+    layout_file = PATH_TMP / chain / "page_layout.html"
+    m = re.search(r'data-site-root="([^"]*)"', layout_file.read_text(encoding="utf-8"))
+    if m is None:
+        raise ValueError(f"No site root in the layout {layout_file}")
+    return m.group(1)
+
+
+def publish_html_pages(chain):
+    """
+    Add the html stash pages (with their figures) of web/<chain> to the built site.
+    """
+    logging.info(f"Publishing the html pages of {chain}.")
+    last_1kv = pd.read_feather(PATH_INFO / chain / "last_info_1kv.feather", columns=["stash"])
+    nb_published = 0
+    for addr in last_1kv["stash"]:
+        public_dir = PATH_DOKS_ROOT / "public" / chain / addr
+        public_dir.mkdir(parents=True, exist_ok=True)
+        for f in (PATH_WEB / chain / addr).iterdir():
+            # not the md page of an earlier run in hugo mode
+            if not f.name.startswith(".") and f.suffix != ".md":
+                nb_published += publish_file(f, public_dir / f.name)
+    logging.info(f"   Published {nb_published} new or changed files.")
 
 def generate_angel_pages(chain):
     logging.info(f"Generating new angel page for {chain}.")
@@ -130,23 +388,15 @@ def generate_angel_pages(chain):
     logging.info(f"  Making webpage")        
     addr_path_web = PATH_WEB / chain / "angel"
     addr_path_web.mkdir(exist_ok=True)
-    file_template = PATH_WEB / "templates" / chain  / "angel.md"
-    addr_file_index = addr_path_web / "index.md"
-    print(file_template)
-    print(addr_file_index)
-    copy(file_template, addr_file_index)
+    template = PageTemplate.from_file(PATH_WEB / "templates" / chain  / "angel.md", ["$ANGEL_LATEST_ERA$"])
 
     # copy figures
     path_new_figs = PATH_NEWFIGS / chain / "angel"
     for f in path_new_figs.glob("*.png"):
-        copy(f, addr_path_web)
+        publish_file(f, addr_path_web / f.name)
 
     latest_era = delay_score_backend["era"].max()
-    subs = {"$ANGEL_LATEST_ERA$": f"{latest_era}"}
-    for key, value in subs.items():   
-        with fileinput.FileInput(addr_file_index, inplace=True) as file:
-            for line in file:
-                print(line.replace(key, value), end='')
+    template.write(addr_path_web / "index.md", {"$ANGEL_LATEST_ERA$": f"{latest_era}"})
 
     logging.info("   Generating angle page done.")
                 
@@ -165,13 +415,31 @@ def copy_to_website(chain):
     # if os.path.exists(bak_dir) and os.path.isdir(bak_dir):
     #     rmtree(bak_dir)
     # os.rename(doks_content_dir / chain, PATH_TMP / f"{chain}-doks-bak")
-    copytree(PATH_WEB / chain, doks_content_dir / chain, dirs_exist_ok=True)
+    # hard links (or copies) of the pages and figures, unchanged files are skipped
+    if PAGE_MODE == "html":
+        # only the angel page, the stash pages are not built by Hugo (see publish_html_pages)
+        publish_tree(PATH_WEB / chain / "angel", doks_content_dir / chain / "angel")
+        stashes = pd.read_feather(PATH_INFO / chain / "last_info_1kv.feather", columns=["stash"])["stash"]
+        for addr in stashes:
+            if (doks_content_dir / chain / addr).is_dir():
+                rmtree(doks_content_dir / chain / addr)
+        write_layout_page(chain)
+    else:
+        publish_tree(PATH_WEB / chain, doks_content_dir / chain)
     # copy(PATH_TMP / f"{chain}-doks-bak/_index.md", doks_content_dir / chain)
 
     # copytree(PATH_WEB / "polkadot", doks_content_dir / "polkadot")
     copy(PATH_INFO / chain / "last_score.csv", PATH_DOKS_ROOT / f"_data/{chain}/scores.csv")
     copy(PATH_INFO / chain / "last_location.csv", PATH_DOKS_ROOT / f"_data/{chain}/locations.csv")
     copy(PATH_INFO / chain / "last_provider.csv", PATH_DOKS_ROOT / f"_data/{chain}/providers.csv")
+    copy(PATH_INFO / chain / "last_th_score.csv", PATH_DOKS_ROOT / f"_data/{chain}/th_scores.csv")
+    # shared data of the stash pages, used by the page-data and score-age shortcodes
+    if PAGE_MODE != "html":
+        (PATH_DOKS_ROOT / "data" / chain).mkdir(parents=True, exist_ok=True)
+        copy(PATH_INFO / chain / "pages.json", PATH_DOKS_ROOT / "data" / chain / "pages.json")
+    if FIGURE_MODE == "data":
+        # served as /charts/<chain>/<field>.json, see the score-chart shortcode
+        publish_tree(PATH_NEWFIGS / chain / "charts", PATH_DOKS_ROOT / "static/charts" / chain)
 
     logging.info("   Copy done.")
         
@@ -197,58 +465,63 @@ def build_website():
         sys.exit(1)
         
 
-def upload_website():
+def upload_website(chains=("kusama", "polkadot")):
     """
-    Upload website with rclone to "InsightWebsite". This should be configured before.
+    Upload the changes of the website with rclone to UPLOAD_REMOTE (see upload.py). The remote should be configured before.
+    The manifest of the uploaded files is tmp/upload_manifest.json; remove it for a full sync.
     """
-    logging.info("Uploading website with rclone.")
-    for filename in (PATH_DOKS_ROOT / "public/kusama" ).rglob("*.png"):        
-        filename.unlink()
-    for filename in (PATH_DOKS_ROOT / "public/polkadot" ).rglob("*.png"):        
-        filename.unlink()    
-
-    # does not seem to work ?!?
-    #if ~os.path.exists(PATH_DOKS_ROOT / "public_html"):
-    #    os.symlink(PATH_DOKS_ROOT / "public", PATH_DOKS_ROOT / "public_html", target_is_directory=True)    
-    # TODO in config
-    PATH_WEBSITE = (PATH_DOKS_ROOT / "public").resolve()
-    t1 = time.time()
-    my_env = os.environ.copy()
-    my_env["PATH"] = "/usr/bin:" + my_env["PATH"]
-    cmd_rclone = f"rclone sync --stats-log-level NOTICE --stats 5m {PATH_WEBSITE} InsightWebsite:./"
-    out = subprocess.run(cmd_rclone, shell=True, capture_output=True, cwd=PATH_DOKS_ROOT, env=my_env)
-    logging.info(f"   Done with uploading in {time.time()-t1} sec")
+    logging.info("Uploading website.")
+    if UPLOAD_LOCAL_DIR is not None:
+        destination = LocalDirDestination(UPLOAD_LOCAL_DIR, transfers=UPLOAD_TRANSFERS)
+    else:
+        destination = RcloneDestination(UPLOAD_REMOTE, transfers=UPLOAD_TRANSFERS)
 
-    print(out.stdout)
-    print(out.stderr)
-    print(out.returncode)
+    def exclude(path):
+        # the png figures of the md pages are only used by Hugo (which publishes webp versions)
+        return PAGE_MODE != "html" and path.endswith(".png") and path.split("/", 1)[0] in chains
 
-    if out.returncode==0:
+    ok = upload((PATH_DOKS_ROOT / "public").resolve(), destination, PATH_TMP / "upload_manifest.json", exclude=exclude)
+    if ok:
         logging.info("   Upload done.")
     else:
         logging.info("   Upload failed.")
-        logging.info(out.stdout)
-
-    # TODO remove old files since each webp is new. This can be done afterwards.
-
 
 
 def main_loop():    
+    all_chains = ["kusama", "polkadot"]
+    chains = all_chains
+    # workers live as long as the loop (they do not log, see generate_chains)
+    pool = ProcessPoolExecutor(max_workers=CPU_BUDGET)
     while(True):                        
         logging.info("Starting with generation of doks website for stashes.")
-        # all md pages and figures are first built locally under web/
-        generate("kusama")  # 1 min
-        generate("polkadot")  # 1 min        
-        generate_angel_pages("kusama") 
-        generate_angel_pages("polkadot")        
-        # then the pages are copied over to the doks/content dir
-        copy_to_website("kusama")
-        copy_to_website("polkadot")
-        # and build by hugo
-        build_website()  # 5 min  
+        if PAGE_MODE == "html":
+            # Hugo only builds the hand-written pages, the angel pages and the layout pages
+            for chain in chains:
+                generate_angel_pages(chain) 
+            for chain in chains:
+                copy_to_website(chain)
+            build_website()
+            # the stash pages are rendered in the layout of the fresh build and added to it. The build starts
+            # from an empty public dir, so for all chains (unchanged pages are not written nor uploaded again)
+            pool_ok = generate_chains(all_chains, {chain: extract_page_layout(chain) for chain in all_chains}, pool, CPU_BUDGET)
+            for chain in all_chains:
+                publish_html_pages(chain)
+        else:
+            # all md pages and figures are first built locally under web/, the angel pages meanwhile
+            pool_ok = generate_chains(chains, pool=pool, n_jobs=CPU_BUDGET, angel=True)
+            # then the pages are copied over to the doks/content dir
+            for chain in chains:
+                copy_to_website(chain)
+            # and build by hugo
+            build_website()  # 5 min  
+        if not pool_ok:
+            # a worker died: new workers for the next cycle
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = ProcessPoolExecutor(max_workers=CPU_BUDGET)
         upload_website() # 5 min
         logging.info("   Generation website done.")
-        time.sleep(2*60*60.0 + (5.0+random.random())*2) # every 2h
+        # new scores trigger the next run, at the latest after 2h
+        chains = wait_for_events("website", timeout=2*60*60.0 + (5.0+random.random())*2)
                 
         
     
@@ -0,0 +1,126 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Append-only history of the latest 1kv info per analysis (all_last_info_1kv), partitioned by era.
+
+The history is a directory of feather partitions named <first era>-<last era>-<time ns>.feather:
+each call of append_history writes one small partition with the rows of that analysis.
+compact_history merges the partitions of eras that are complete (older than the newest era) into
+one partition per block of eras, named <first era>-<last era>-<time ns>.c.feather. A compacted
+partition supersedes all partitions in its era range that are not newer than it, so the merged
+partitions can be deleted afterwards (and a crash in between does not duplicate rows).
+
+Readers only open the partitions that overlap the era range they ask for.
+"""
+
+import os
+import time
+import pandas as pd
+
+COMPACT_SUFFIX = ".c.feather"
+
+
+def _write_atomic(df, path):
+    tmp = path.with_name(path.name + ".tmp")
+    df.reset_index(drop=True).to_feather(tmp)
+    os.replace(tmp, path)
+
+
+def _list_partitions(history_dir):
+    """
+    All partitions as a dataframe with columns file, first, last, ns and compacted, in the order of the rows.
+    Partitions superseded by a compacted partition are marked in the column superseded.
+    """
+    rows = []
+    for f in history_dir.glob("*.feather"):
+        compacted = f.name.endswith(COMPACT_SUFFIX)
+        stem = f.name[:-len(COMPACT_SUFFIX)] if compacted else f.stem
+        first, last, ns = (int(x) for x in stem.split("-"))
+        rows.append((f, first, last, ns, compacted))
+    parts = pd.DataFrame.from_records(rows, columns=["file", "first", "last", "ns", "compacted"])
+    parts = parts.sort_values(["first", "ns"]).reset_index(drop=True)
+
+    parts["superseded"] = False
+    for c in parts[parts["compacted"]].itertuples():
+        parts.loc[(parts.index != c.Index) & (parts["first"] >= c.first) & (parts["last"] <= c.last)
+                  & (parts["ns"] <= c.ns), "superseded"] = True
+    return parts
+
+
+def append_history(history_dir, df):
+    """
+    Add the rows of df (with an era column) as a new partition.
+    """
+    history_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{int(df['era'].min())}-{int(df['era'].max())}-{time.time_ns()}.feather"
+    _write_atomic(df, history_dir / name)
+
+
+def read_history(history_dir, first_era=None, last_era=None, columns=None):
+    """
+    The rows of the history with first_era <= era <= last_era (None for no bound), in the order they were added.
+    With columns, only these columns are read.
+    """
+    if not history_dir.exists():
+        raise FileNotFoundError(f"No history in {history_dir}")
+    parts = _list_partitions(history_dir)
+    parts = parts[~parts["superseded"]]
+    if first_era is not None:
+        parts = parts[parts["last"] >= first_era]
+    if last_era is not None:
+        parts = parts[parts["first"] <= last_era]
+
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ["era"]))
+    df_s = [pd.read_feather(f, columns=read_columns) for f in parts["file"]]
+    if not df_s:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(df_s, ignore_index=True)
+    if first_era is not None:
+        df = df[df["era"] >= first_era]
+    if last_era is not None:
+        df = df[df["era"] <= last_era]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def compact_history(history_dir, block_eras=28):
+    """
+    Merge the partitions of complete eras (all eras before the newest one) into one partition per block of
+    block_eras eras and delete the merged and superseded partitions. Returns the number of merged partitions.
+    """
+    parts = _list_partitions(history_dir)
+    for f in parts[parts["superseded"]]["file"]:
+        f.unlink(missing_ok=True)
+    parts = parts[~parts["superseded"]]
+    if parts.empty:
+        return 0
+
+    newest_era = parts["last"].max()
+    parts = parts[parts["last"] < newest_era].copy()
+    parts["block"] = parts["first"] // block_eras
+    parts = parts[parts["block"] == parts["last"] // block_eras]
+
+    nb_merged = 0
+    for block, group in parts.groupby("block"):
+        if len(group) < 2:
+            continue
+        df = pd.concat([pd.read_feather(f) for f in group["file"]], ignore_index=True)
+        name = f"{group['first'].min()}-{group['last'].max()}-{group['ns'].max()}{COMPACT_SUFFIX}"
+        _write_atomic(df, history_dir / name)
+        # the new partition supersedes the merged ones from now on
+        for f in group["file"]:
+            f.unlink(missing_ok=True)
+        nb_merged += len(group)
+    return nb_merged
+
+
+def history_from_frame(history_dir, df, block_eras=28):
+    """
+    Convert the old all_last_info_1kv.feather dataframe into a history (one partition per block of eras).
+    """
+    history_dir.mkdir(parents=True, exist_ok=True)
+    ns = time.time_ns()
+    for block, group in df.groupby(df["era"] // block_eras, sort=True):
+        name = f"{int(group['era'].min())}-{int(group['era'].max())}-{ns}{COMPACT_SUFFIX}"
+        _write_atomic(group, history_dir / name)
@@ -10,12 +10,19 @@ import random
 import json
 import pickle
 from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import sys
-from substrateinterface import SubstrateInterface
+from substrate_pool import query_active_era
 import os
 import time
 
 from scores_1kv import *
+from snapshots_1kv import read_1kv_snapshots
+from activity_matrix import read_activity
+from score_tensor import read_score_tensor, write_score_tensor
+from history_1kv import append_history, compact_history, read_history, history_from_frame
+from pipeline_events import emit_event, wait_for_events
 
 PATH_JSON  = Path.cwd() / "../1kv_json"
 PATH_ONCHAIN = Path.cwd() / "../onchain"
@@ -25,6 +32,13 @@ PATH_TMP = Path.cwd() / "../tmp"
 
 NB_ERAS_TO_PROCESS = 200
 
+# The chains are processed in parallel worker processes. The cores for the figure workers are
+# split over the chains that run at the same time according to their share.
+CPU_BUDGET = os.cpu_count() or 4
+CPU_SHARE = {"kusama": 0.5, "polkadot": 0.5}
+# A figure task builds its renderer once, so it should have at least this many addresses
+MIN_FIGURE_BATCH = 25
+
 
 def calculate_oldest_datetime(chain):
     cur_time = int(time.time()) # in seconds
@@ -37,11 +51,20 @@ def calculate_oldest_datetime(chain):
     return cur_time - NB_ERAS_TO_PROCESS * secs_in_one_era
         
     
+def address_batches(n_addresses, n_jobs, min_batch=MIN_FIGURE_BATCH, tasks_per_job=4):
+    """
+    Split the positions of n_addresses into batches for the figure workers: a few batches per worker
+    so the load stays balanced, but none smaller than min_batch. Returns (batches, n_jobs), with
+    n_jobs lowered if there are fewer batches than workers.
+    """
+    n_batches = max(1, min(n_jobs * tasks_per_job, n_addresses // min_batch))
+    return np.array_split(np.arange(n_addresses), n_batches), max(1, min(n_jobs, n_batches))
+
 def merge_dumps(chain):
     # 1kv json files
     logging.info("Reading 1kv json files...")
-    df_1kv = read_1kv_json(PATH_JSON / chain, oldest_datetime=calculate_oldest_datetime(chain))    
-    df_1kv.to_feather(PATH_TMP / chain / "df_1kv.feather")
+    # df_1kv.feather is the consolidated store: only the snapshots dumped since the last run are read
+    df_1kv = read_1kv_snapshots(PATH_JSON / chain, PATH_TMP / chain / "df_1kv.feather", oldest_datetime=calculate_oldest_datetime(chain))
     stash_1kv = df_1kv.stash.unique()
     pickle.dump(stash_1kv, open(PATH_TMP / chain/ "stash_1kv.p", "wb"))  
     
@@ -50,13 +73,14 @@ def merge_dumps(chain):
     start_era_onchain = read_onchain_era_start_file(PATH_ONCHAIN / chain / "on_chain_era_start.feather")
     # Select only 1kv validators
     logging.info("--- 1 Reading on chain files...")
-    df_era_reward_onchain = read_onchain_erareward_files(PATH_ONCHAIN / chain / "all" ).query("address in @stash_1kv").reset_index(drop=True)    
+    df_era_reward_onchain = update_onchain_erareward_store(PATH_ONCHAIN / chain / "all", PATH_TMP / chain / "era_reward_all.feather")
+    df_era_reward_onchain = df_era_reward_onchain.query("address in @stash_1kv").reset_index(drop=True)
     logging.info("--- 2 Reading on chain files...")
     df_era_reward_onchain.to_feather(PATH_TMP / chain / "df_era_reward_onchain.feather")
 
     logging.info("  Done with merging dumped files.")
 
-def compute_scores(chain):  
+def compute_scores(chain, n_jobs=CPU_BUDGET):  
     # Load files  
     df_1kv = pd.read_feather(PATH_TMP / chain / "df_1kv.feather")
 
@@ -71,7 +95,9 @@ def compute_scores(chain):
     ## Simple extraction of scores and stats 
     # 28 Oct 2022: Valid is always None for recent. With drop na they get all removed!
     fields = ["stash", "name", "score.datetime", "score.session", "dump.datetime", "rank", "faults", "commission", "location", "provider", "valid"] + list(descr_scores[chain].keys())
-    last_1kv = df_1kv[fields].dropna()      
+    # and the inputs of the theoretical scores that are in the dump (may be missing, see recompute_scores)
+    inputs = [c for c in score_input_columns(chain) if c in df_1kv.columns and c not in fields]
+    last_1kv = df_1kv[fields + inputs].dropna(subset=fields)
     last_1kv = last_1kv.sort_values('dump.datetime').drop_duplicates(["stash"], keep='last').reset_index(drop=True)
     last_1kv.to_json(PATH_INFO / chain / "last_info_1kv.json")
     last_1kv.to_feather(PATH_INFO / chain / "last_info_1kv.feather") 
@@ -95,41 +121,33 @@ def compute_scores(chain):
     # turn into wide for easier visual
     era_reward_onchain = df_era_reward_onchain.pivot(index="address", columns="era", values="points").replace(np.nan, 0)
     # print(era_reward_onchain)
-    try:
-        era_reward_onchain200 = pd.read_feather(PATH_ONCHAIN / chain / "eras_activity.feather")
-        print("File loaded successfully.")
-    except FileNotFoundError:
-        print("eras_activity.feather File not found")
-        exit()
-    # Assuming era_reward_onchain200 and era_reward_onchain are already defined DataFrames
-
-    # Check if era_reward_onchain200 is empty
-    if era_reward_onchain200.empty:
-        print("era_reward_onchain200 is empty")
-        exit()
- 
-    else:
-        # If not empty, identify the latest era in the current DataFrame
-        # Convert column names to string to handle the integer type
-        latest_era = max(int(col) for col in era_reward_onchain200.columns if str(col).isdigit())
-
-
-
-    # Check if each era in the list actually exists in the DataFrame columns
-    existing_eras = [str(era) for era in eras_list if str(era) in era_reward_onchain200.columns]
+    # Activity matrix (stash x era) stored by active_eras.py, read memory mapped
+    activity, activity_stashes, activity_eras = read_activity(PATH_ONCHAIN / chain / "eras_activity")
+    if activity.size == 0:
+        # an exception and not exit(): only this chain fails (see run_chains)
+        raise ValueError(f"eras_activity store of {chain} is empty")
+
+    # Only keep the eras that are in the on chain era list; a contiguous block stays a view of the memory map
+    cols = np.flatnonzero(np.isin(activity_eras, eras_list))
+    if len(cols) > 0 and cols[-1] - cols[0] + 1 == len(cols):
+        cols = slice(cols[0], cols[-1] + 1)
+    activity = activity[:, cols]
+    activity_eras = activity_eras[cols]
 
-    # Use the existing eras to filter the DataFrame
-    filtered_df = era_reward_onchain200.loc[:, ['index'] + existing_eras]
-
-
-    logging.info("Making activity figures")
     save_dir = PATH_NEWFIGS / chain
-
-    # for addr in df_stash['stash']:    
-    #     if addr == 'GM31KcErdS3ob8wmFSbLycccJ6YGvvTXLBAawd6d9wkAxqj':
-    #         make_figs_active(filtered_df, addr, save_dir)  
-    # exit()  
-    Parallel(n_jobs=4)(delayed(make_figs_active)(filtered_df, a, save_dir) for a in df_stash['stash']) 
+    if FIGURE_MODE == "data":
+        logging.info("Writing activity chart data")
+        chart_data_activity(activity, activity_stashes, activity_eras, df_stash['stash'].tolist(), save_dir / "charts")
+    else:
+        logging.info("Making activity figures")
+        # batches of addresses so each task builds its figure once; unchanged figures are skipped
+        cache_file = save_dir / "render_cache_activity.json"
+        cache = read_render_cache(cache_file)
+        # activity is memory mapped, the workers get a reference to the file and not a copy
+        addresses = df_stash['stash'].values
+        batches, n_workers = address_batches(len(addresses), n_jobs)
+        hashes = Parallel(n_jobs=n_workers)(delayed(make_figs_active_batch)(activity, activity_stashes, activity_eras, addresses[b], save_dir, batch_render_cache(cache, addresses[b])) for b in batches) 
+        write_render_cache(cache_file, hashes)
 
     # Calculate time stamps of eras so we can compare with data reported by 1kv json
     if chain=="kusama":
@@ -157,12 +175,11 @@ def compute_scores(chain):
 
     ## Align score to era
     logging.info("Aligning 1kv score to era")        
-    scores_1kv_era = {}
-    scores_1kv_era_update = {}
-    for score in descr_scores[chain].keys():
-        scores_1kv_era[score], scores_1kv_era_update[score] = align_score_1kv_to_era(df_1kv, score, df_eras_start_end, stash_1kv)
-    pickle.dump(scores_1kv_era, open(PATH_TMP / chain/ "scores_1kv_era.p", "wb"))
-    pickle.dump(scores_1kv_era_update, open(PATH_TMP / chain / "scores_1kv_era_update.p", "wb"))    
+    score_fields = list(descr_scores[chain].keys())
+    scores_1kv_era, scores_1kv_era_update = align_scores_1kv_to_era(df_1kv, score_fields, df_eras_start_end, stash_1kv)
+    # (score x stash x era) tensor store, read memory mapped by the next stages (see score_tensor.py)
+    scores, updates, score_stashes, score_eras = score_arrays(scores_1kv_era, scores_1kv_era_update, score_fields)
+    write_score_tensor(PATH_TMP / chain / "scores_1kv_era", scores, updates, score_fields, score_stashes, score_eras)
     
 def recompute_scores(chain):
     ## Recompute existing scores as th-score.XX and add to last_1kv
@@ -172,9 +189,16 @@ def recompute_scores(chain):
     # First take care of blacklisted providers
     last_1kv["provider.blacklist"] = last_1kv["provider"].isin(blacklist_provider[chain])
 
+    # th-score.<field> of all fields with their inputs in last_1kv, in one pass (see theoretical_scores)
+    th, counts = theoretical_scores(chain, last_1kv)
+    last_1kv = last_1kv.drop(columns=[c for c in th.columns if c in last_1kv.columns]).join(th)
     for field in ["location", "provider"]:
-        (last_field, last_1kv) = recompute_score_from_quantile(chain, last_1kv, field, True)
-        last_field.to_csv(PATH_INFO / chain / f"last_{field}.csv")
+        counts[field].to_csv(PATH_INFO / chain / f"last_{field}.csv")
+    # reported and theoretical score of each field, side by side
+    th_fields = [c.removeprefix("th-score.") for c in th.columns if c.startswith("th-score.")]
+    last_th_score = last_1kv[["name", "stash"] + [c for f in th_fields for c in (f"score.{f}", f"th-score.{f}")]]
+    last_th_score.to_csv(PATH_INFO / chain / "last_th_score.csv")
+    logging.info(f"   Recomputed {', '.join(th_fields)}")
     
     last_1kv.to_json(PATH_INFO / chain / "last_info_1kv.json")
     last_1kv.to_feather(PATH_INFO / chain / "last_info_1kv.feather")    
@@ -208,111 +232,160 @@ def save_new_scores(chain):
     We can compare later if data is consistent
     """
     logging.info("Saving last info with era information.")
-    stash_1kv = pickle.load(open(PATH_TMP /chain / "stash_1kv.p", "rb"))
-    scores_1kv_era = pickle.load(open(PATH_TMP / chain / "scores_1kv_era.p", "rb"))
-    scores_1kv_era_update = pickle.load(open(PATH_TMP / chain / "scores_1kv_era_update.p", "rb"))
     last_1kv = pd.read_feather(PATH_INFO / chain / "last_info_1kv.feather") 
 
-    # TODO: factor out from active_eras.py
-    # get current era
+    # get current era (shared connection and cache, see substrate_pool.py)
     # https://substrate.stackexchange.com/questions/5165/what-is-the-difference-between-currentera-and-activeera
-    if chain=='kusama':        
-        url = "wss://rpc.ibp.network/kusama"
-    elif chain=='polkadot':            
-        url = "wss://rpc.ibp.network/polkadot"
-        
     try:
-        substrate = SubstrateInterface(url=url)
+        cur_era, cur_era_start = query_active_era(chain)
     except ConnectionRefusedError:
-        sys.exit("⚠️ Remote RPC server didn't respond")
-
-    result = substrate.query(module='Staking', storage_function='ActiveEra')
-    cur_era = result['index'].decode()
-    cur_era_start = result['start'].decode()
+        raise ConnectionError(f"⚠️ Remote RPC server didn't respond for {chain}")
     cur_time = time.time()
     last_1kv["era"] = cur_era
     last_1kv["analysis.datetime"] = cur_time
 
-    if os.path.isfile(PATH_INFO / chain / "all_last_info_1kv.feather"):
-        all_last_1kv = pd.read_feather(PATH_INFO / chain / "all_last_info_1kv.feather") 
-        all_last_1kv = pd.concat([all_last_1kv, last_1kv]).reset_index(drop=True)       
-    else:
-        all_last_1kv = last_1kv.copy().reset_index(drop=True)
-    all_last_1kv.to_feather(PATH_INFO / chain / "all_last_info_1kv.feather") 
+    # append-only history partitioned by era (see history_1kv.py), converted once from all_last_info_1kv.feather
+    history_dir = PATH_INFO / chain / "all_last_info_1kv"
+    if not history_dir.exists() and os.path.isfile(PATH_INFO / chain / "all_last_info_1kv.feather"):
+        history_from_frame(history_dir, pd.read_feather(PATH_INFO / chain / "all_last_info_1kv.feather"))
+    append_history(history_dir, last_1kv.reset_index(drop=True))
+    # merge the small partitions of the eras that are complete
+    nb_merged = compact_history(history_dir)
+    if nb_merged > 0:
+        logging.info(f"   Compacted {nb_merged} history partitions")
 
     logging.info("   Done!")
 
 def calc_delay_score_backend(chain):
     logging.info("Calculating delay of scores.")
-    all_last_1kv = pd.read_feather(PATH_INFO / chain / "all_last_info_1kv.feather")   
-
-    tmp = all_last_1kv.copy()
-    tmp["diff"] = pd.to_timedelta(tmp["dump.datetime"] - tmp["score.datetime"]) 
-    eras = tmp["era"].unique()
-
-    delay_score_backend = pd.DataFrame()
-    delay_score_backend_quantiles = pd.DataFrame()
-    for era in eras:
-        # Multiple values per era. Take minimal one to get optimistic value.
-        tmp_era_min = tmp[tmp["era"]==era].groupby("stash")["diff"].min()
-        tmp_era = pd.DataFrame(tmp_era_min).reset_index()
-        tmp_era["era"] = era
-        cur_quant = {}
-        cur_quant['quantiles.levels'] = np.array([0.9, 0.75, 0.5, 0.25, 0.1])
-        cur_quant['quantiles.values'] = tmp_era_min.quantile(cur_quant['quantiles.levels']).values
-        cur_quant = pd.DataFrame.from_dict(cur_quant)
-        cur_quant["era"] = era
-        delay_score_backend_quantiles = pd.concat([delay_score_backend_quantiles, cur_quant]).reset_index(drop=True)
-        delay_score_backend = pd.concat([delay_score_backend, tmp_era]).reset_index(drop=True)
-        
-    delay_score_backend = delay_score_backend.reset_index(drop=True)
-    delay_score_backend.to_feather(PATH_INFO / chain / "delay_score_backend.feather") 
-
-    delay_score_backend_quantiles["hours"] = delay_score_backend_quantiles["quantiles.values"] / np.timedelta64(1, 'h') # trick to get hours
-    delay_score_backend_quantiles = delay_score_backend_quantiles.reset_index(drop=True)
-    delay_score_backend_quantiles.to_feather(PATH_INFO / chain / "delay_score_backend_quantiles.feather") 
-    #return (delay_score_backend, delay_score_backend_quantiles)    
+    delay_file = PATH_INFO / chain / "delay_score_backend.feather"
+    quantiles_file = PATH_INFO / chain / "delay_score_backend_quantiles.feather"
+
+    # save_new_scores only adds rows for the current era, so the eras before the last one in the
+    # output are final and kept; the last era and newer ones are computed again
+    if delay_file.exists() and quantiles_file.exists():
+        delay_score_backend = pd.read_feather(delay_file)
+        delay_score_backend_quantiles = pd.read_feather(quantiles_file)
+        last_era = delay_score_backend["era"].max()
+        delay_score_backend = delay_score_backend[delay_score_backend["era"] < last_era]
+        delay_score_backend_quantiles = delay_score_backend_quantiles[delay_score_backend_quantiles["era"] < last_era]
+    else:
+        delay_score_backend = None
+        delay_score_backend_quantiles = None
+        last_era = None
+
+    # only the partitions of the history from last_era on are read
+    all_last_1kv = read_history(PATH_INFO / chain / "all_last_info_1kv", first_era=last_era, columns=["stash", "era", "dump.datetime", "score.datetime"])
+    new_delay, new_quantiles = calc_delay_per_era(all_last_1kv)
+    logging.info(f"   Delay computed for {new_delay['era'].nunique()} eras")
+
+    delay_score_backend = pd.concat([delay_score_backend, new_delay]).reset_index(drop=True)
+    delay_score_backend.to_feather(delay_file) 
+    delay_score_backend_quantiles = pd.concat([delay_score_backend_quantiles, new_quantiles]).reset_index(drop=True)
+    delay_score_backend_quantiles.to_feather(quantiles_file) 
     logging.info("   Done!")
 
 
-def make_figures(chain):
-    stash_1kv = pickle.load(open(PATH_TMP /chain / "stash_1kv.p", "rb"))
-    scores_1kv_era = pickle.load(open(PATH_TMP / chain / "scores_1kv_era.p", "rb"))
-    scores_1kv_era_update = pickle.load(open(PATH_TMP / chain / "scores_1kv_era_update.p", "rb"))
+def make_figures(chain, n_jobs=CPU_BUDGET):
+    # memory mapped: the workers get a reference to the files and only read the rows of their batch
+    scores, updates, fields, stashes, eras = read_score_tensor(PATH_TMP / chain / "scores_1kv_era")
+    if fields != list(descr_scores[chain].keys()):
+        raise ValueError(f"Score store of {chain} has fields {fields}, expected {list(descr_scores[chain].keys())}.")
     delay_score_backend_quantiles = pd.read_feather(PATH_INFO / chain / "delay_score_backend_quantiles.feather") 
     delay_score_backend = pd.read_feather(PATH_INFO / chain / "delay_score_backend.feather") 
 
-    logging.info("Making figures")
     save_dir = PATH_NEWFIGS / chain
     t1 = time.time()
-    # Parallel loop for
-    # for addr in stash_1kv:    
-    #    make_figs_all_scores(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, addr, save_dir)    
-    Parallel(n_jobs=4)(delayed(make_figs_all_scores)(scores_1kv_era, scores_1kv_era_update, descr_scores[chain], bound_scores[chain], a, save_dir) for a in stash_1kv)    
-    logging.info(f"   Done with big figures in {time.time()-t1} sec")
+    if FIGURE_MODE == "data":
+        logging.info("Writing score chart data")
+        chart_data_scores(scores, updates, stashes, eras, descr_scores[chain], bound_scores[chain], save_dir / "charts")
+        logging.info(f"   Done with chart data in {time.time()-t1} sec")
+    else:
+        logging.info("Making figures")
+        # Parallel loop for
+        # for addr in stash_1kv:    
+        #    make_figs_all_scores(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, addr, save_dir)    
+        # batches of addresses so each task builds the figures of the score fields once; unchanged figures are skipped
+        cache_file = save_dir / "render_cache_scores.json"
+        cache = read_render_cache(cache_file)
+        addresses = stashes.to_numpy()
+        batches, n_workers = address_batches(len(addresses), n_jobs)
+        hashes = Parallel(n_jobs=n_workers)(delayed(make_figs_scores_rows)(scores, updates, eras, descr_scores[chain], bound_scores[chain], b, addresses[b], save_dir, batch_render_cache(cache, addresses[b])) for b in batches)    
+        write_render_cache(cache_file, hashes)
+        logging.info(f"   Done with big figures in {time.time()-t1} sec")
     
     save_dir_angel = PATH_NEWFIGS / chain / "angel"
     make_figs_delay_score_backend(delay_score_backend_quantiles, save_dir=save_dir_angel)
     make_hist_fig_delay_score_backend(delay_score_backend, save_dir=save_dir_angel)
     logging.info(f"   Done with histogram")
 
+def process_chain(chain, n_jobs):
+    """
+    The full pipeline for one chain. Returns the wall time in sec.
+    """
+    t1 = time.time()
+    logging.info(f" -- {chain} -- ")
+    merge_dumps(chain)      
+    compute_scores(chain, n_jobs)
+    recompute_scores(chain)
+    save_new_scores(chain)
+    calc_delay_score_backend(chain)
+    make_figures(chain, n_jobs) # takes 2 min on mac
+    return time.time() - t1
+
+def _init_worker():
+    logging.basicConfig(level=logging.INFO)
+
+def make_pool():
+    # workers live as long as the pool, so they keep their connections (see substrate_pool.py)
+    return ProcessPoolExecutor(max_workers=len(CPU_SHARE), initializer=_init_worker)
+
+def run_chains(pool, chains, cpu_budget=CPU_BUDGET):
+    """
+    Run the pipelines of the chains in separate processes of pool (they share no state) and report 
+    each chain as soon as it is done.
+
+    Returns False if the pool is broken (a worker died, e.g. killed when out of memory); it cannot run
+    anything anymore and has to be replaced.
+    """
+    total_share = sum(CPU_SHARE[chain] for chain in chains)
+    futures = {}
+    try:
+        for chain in chains:
+            n_jobs = max(1, round(cpu_budget * CPU_SHARE[chain] / total_share))
+            futures[pool.submit(process_chain, chain, n_jobs)] = chain
+    except BrokenProcessPool:
+        logging.exception(" FAILED TO START -- worker pool is broken -- ")
+        return False
+    pool_ok = True
+    for future in as_completed(futures):
+        chain = futures[future]
+        try:
+            secs = future.result()
+        except BrokenProcessPool:
+            logging.exception(f" FAILED FOR -- {chain} -- a worker died")
+            pool_ok = False
+            continue
+        except Exception:
+            logging.exception(f" FAILED FOR -- {chain} -- ")
+            continue
+        emit_event("website", chain, "score")
+        logging.info(f" DONE FOR -- {chain} -- in {secs:.0f} sec")
+    return pool_ok
+
 def main_loop():    
     logging.info("Starting main loop")    
+    chains = ["kusama", "polkadot"]
+    pool = make_pool()
     while(True):        
-        
-        for chain in ["kusama", "polkadot"]:
-            logging.info(f" -- {chain} -- ")
-            merge_dumps(chain)      
-            compute_scores(chain)
-            recompute_scores(chain)
-            save_new_scores(chain)
-            calc_delay_score_backend(chain)
-            make_figures(chain) # takes 2 min on mac
-            logging.info(f" DONE FOR -- {chain} -- ")
-        
-            time.sleep(10*random.random()) 
+        if not run_chains(pool, chains):
+            # new workers for the next cycle
+            logging.info("Replacing the broken worker pool")
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = make_pool()
                         
-        time.sleep(1.5*60*60.0+10*random.random())  # 1.5h
+        # new 1kv dumps or on-chain data trigger the next run, at the latest after 1.5h
+        chains = wait_for_events("score", timeout=1.5*60*60.0+10*random.random())
                 
         
     
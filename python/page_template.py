@@ -0,0 +1,70 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Minimal template engine for the generated pages in web/templates.
+
+A template is parsed once into literal segments and placeholder segments; a page is rendered in
+memory by joining the segments with the values of the placeholders. Placeholders are plain strings
+in the template, e.g. STASH, DATETIME or $RANK$.
+"""
+
+import os
+import re
+
+# Anything that looks like a placeholder ($NAME$) must be a known placeholder
+PLACEHOLDER_PATTERN = re.compile(r"\$[A-Za-z0-9_.-]+\$")
+
+
+class PageTemplate:
+    """
+    Template parsed into segments for the given placeholder names.
+
+    Raises a ValueError if the template contains a $...$ placeholder that is not in placeholders,
+    so a typo in a template is detected before any page is written. Use strict=False for a 
+    template that is not ours (e.g. html with scripts).
+    """
+    def __init__(self, text, placeholders, name="template", strict=True):
+        self.name = name
+        self.placeholders = frozenset(placeholders)
+        # longest first, so a placeholder that contains another one wins
+        keys = sorted(self.placeholders, key=len, reverse=True)
+        pattern = re.compile("|".join(re.escape(key) for key in keys))
+
+        # literals at the even positions, placeholder names at the odd positions
+        self.segments = []
+        pos = 0
+        for m in pattern.finditer(text):
+            self.segments += [text[pos:m.start()], m.group()]
+            pos = m.end()
+        self.segments.append(text[pos:])
+
+        unknown = sorted({p for literal in self.segments[::2] for p in PLACEHOLDER_PATTERN.findall(literal)})
+        if unknown and strict:
+            raise ValueError(f"Unknown placeholders in {name}: {', '.join(unknown)}")
+        self.used = frozenset(self.segments[1::2])
+
+    @classmethod
+    def from_file(cls, path, placeholders, strict=True):
+        with open(path, encoding="utf-8") as f:
+            return cls(f.read(), placeholders, name=str(path), strict=strict)
+
+    def render(self, values):
+        """
+        The page with the placeholders replaced by values (a dict placeholder -> str).
+        """
+        missing = self.used.difference(values)
+        if missing:
+            raise KeyError(f"No value for {', '.join(sorted(missing))} in {self.name}")
+        segments = self.segments.copy()
+        segments[1::2] = [values[key] for key in segments[1::2]]
+        return "".join(segments)
+
+    def write(self, path, values):
+        """
+        Render and write the page in one write. The page is replaced (written to a temporary file that 
+        is renamed), so a published link to the old page keeps the old page.
+        """
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render(values))
+        os.replace(tmp, path)
@@ -0,0 +1,76 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Lightweight file-queue event bus between the services.
+
+A producer drops an empty event file in ../events/<stage>/ when it has new data for that stage,
+e.g. dump-1kv-data.py after a new 1kv dump (stage "score") or make_score_figures.py after new
+scores (stage "website"). The consumer of a stage waits for events instead of sleeping for a fixed
+time: events are debounced (wait until no new event arrived for a while) and coalesced (all pending
+events give one run, for the chains that had events). Without events the consumer still runs after
+a timeout, as before.
+"""
+
+from pathlib import Path
+import logging
+import os
+import time
+
+PATH_EVENTS = Path.cwd() / "../events"
+CHAINS = ("kusama", "polkadot")
+
+
+def emit_event(stage, chain, source):
+    """
+    Signal the consumer of stage that there is new data for chain (source is only informative).
+    """
+    stage_dir = PATH_EVENTS / stage
+    stage_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{time.time_ns()}-{chain}-{source}"
+    # written under a name the consumer ignores and then renamed, so it is never half there
+    tmp = stage_dir / f".{name}.tmp"
+    tmp.touch()
+    os.replace(tmp, stage_dir / f"{name}.event")
+
+
+def pending_events(stage):
+    stage_dir = PATH_EVENTS / stage
+    if not stage_dir.exists():
+        return []
+    return sorted(stage_dir.glob("*.event"))
+
+
+def _event_chain(event):
+    return event.stem.split("-")[1]
+
+
+def wait_for_events(stage, timeout, debounce=60, max_delay=10*60, poll=5, chains=CHAINS):
+    """
+    Block until there are events for stage and return the chains to process (in the order of chains).
+
+    Returns once no new event arrived for debounce seconds, or max_delay seconds after the first
+    event (so a steady stream of events cannot starve the stage). The returned events are consumed;
+    events that arrive later stay queued for the next call. After timeout seconds without any
+    event, all chains are returned.
+    """
+    start = time.monotonic()
+    first_seen = None
+    while True:
+        events = pending_events(stage)
+        now = time.monotonic()
+        if events:
+            if first_seen is None:
+                first_seen = now
+            newest = max(event.stat().st_mtime for event in events)
+            if time.time() - newest >= debounce or now - first_seen >= max_delay:
+                todo = [chain for chain in chains if chain in {_event_chain(event) for event in events}]
+                for event in events:
+                    event.unlink(missing_ok=True)
+                logging.info(f"Stage {stage}: {len(events)} events for {todo}")
+                if todo:
+                    return todo
+                first_seen = None
+        elif now - start >= timeout:
+            logging.info(f"Stage {stage}: no events in {timeout} sec, processing all chains")
+            return list(chains)
+        time.sleep(poll)
@@ -0,0 +1,88 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Publishing of the generated files from new_figs to web and from web to the doks content dir.
+
+Files are hard linked when possible, else reflinked (copy-on-write clone, e.g. on btrfs or xfs),
+else copied. A file that is already published (same inode, or a copy with the same size and
+modification time) is skipped, so publishing an unchanged tree only costs a stat per file.
+
+The producers replace their files (write a temporary file and rename it) instead of rewriting
+them in place, so a new version gets a new inode and the published links keep the old one until
+they are published again.
+"""
+
+import fcntl
+import logging
+import os
+from pathlib import Path
+from shutil import copy2
+
+# ioctl FICLONE of linux/fs.h
+FICLONE = 0x40049409
+
+
+def index_files(directory, suffix=".png"):
+    """
+    List directory once: dict address -> list of the paths of its files (named <address>_...).
+    """
+    index = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(suffix) and "_" in entry.name:
+                index.setdefault(entry.name.split("_")[0], []).append(directory / entry.name)
+    return index
+
+
+def _is_published(src, dst):
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    os.utime(dst, ns=(os.stat(src).st_atime_ns, os.stat(src).st_mtime_ns))
+
+
+def publish_file(src, dst):
+    """
+    Publish src as dst (hard link, reflink or copy). Returns True if dst was (re)published.
+    """
+    if _is_published(src, dst):
+        return False
+    # built next to dst and renamed, so readers never see a missing or half written file
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            _reflink(src, tmp)
+        except OSError:
+            copy2(src, tmp)
+    os.replace(tmp, dst)
+    return True
+
+
+def publish_tree(src_dir, dst_dir):
+    """
+    Publish all files of src_dir in dst_dir, keeping the directory structure (like copytree with dirs_exist_ok).
+    Returns the number of (re)published files.
+    """
+    nb_published = 0
+    for root, dirs, files in os.walk(src_dir):
+        target = dst_dir / os.path.relpath(root, src_dir)
+        target.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            if name.startswith("."):
+                continue
+            nb_published += publish_file(Path(root) / name, target / name)
+    logging.info(f"   Published {nb_published} new or changed files from {src_dir} to {dst_dir}")
+    return nb_published
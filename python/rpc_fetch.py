@@ -0,0 +1,218 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Concurrent fetching of era data over the websocket JSON-RPC interface of a substrate node.
+
+The storage keys and the decoding of the values come from a (synchronous) SubstrateInterface that
+holds the metadata; only the plain JSON-RPC calls (state_getStorage, state_getKeysPaged) go over
+an asyncio websocket connection, with a bounded number of requests in flight, a rate limit and
+retries with exponential backoff. A request on a broken connection is retried on a new connection.
+Any websocket JSON-RPC server can be used, see test_rpc_fetch.py for a local stub.
+
+pip3 install websockets
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+import pandas as pd
+import websockets
+from scalecodec.base import ScaleBytes
+from substrateinterface.utils.ss58 import ss58_encode
+
+
+class RpcError(Exception):
+    """Error returned by the JSON-RPC server."""
+
+
+class AsyncRpcClient:
+    """
+    JSON-RPC client over one websocket connection. Requests are multiplexed by id.
+
+    max_in_flight  -- maximal number of requests waiting for an answer
+    rate_limit     -- maximal number of requests per second (None for no limit)
+    retries        -- number of retries of a failed request (connection errors, timeouts, server errors)
+    backoff        -- first wait before a retry in sec, doubled for each next retry (with jitter)
+    timeout        -- timeout of one request in sec
+    """
+
+    def __init__(self, url, max_in_flight=8, rate_limit=20.0, retries=5, backoff=0.5, timeout=30.0):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._min_interval = 1.0 / rate_limit if rate_limit else 0.0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._rate_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._next_slot = 0.0
+        self._ids = itertools.count(1)
+        self._ws = None
+        self._pending = None
+        self._reader = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+
+    async def _connection(self):
+        async with self._connect_lock:
+            if self._ws is None:
+                # the requests waiting for an answer on this connection, by id
+                self._pending = {}
+                self._ws = await websockets.connect(self.url, max_size=None)
+                self._reader = asyncio.create_task(self._read(self._ws, self._pending))
+            return self._ws, self._pending
+
+    async def _drop(self, ws):
+        """Forget a broken connection and close it, so the next request opens a new one."""
+        async with self._connect_lock:
+            if self._ws is ws:
+                self._ws = None
+                if self._reader is not None:
+                    # fails the other requests on this connection, they are retried as well
+                    self._reader.cancel()
+                    self._reader = None
+        await ws.close()
+
+    async def _read(self, ws, pending):
+        """Dispatch the answers to the waiting requests. A broken connection fails all of them."""
+        try:
+            async for message in ws:
+                answer = json.loads(message)
+                future = pending.pop(answer.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(answer)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self._ws is ws:
+                self._ws = None
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {self.url} closed"))
+            pending.clear()
+
+    async def _wait_rate_limit(self):
+        async with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _request_once(self, method, params):
+        ws, pending = await self._connection()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        try:
+            await ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}))
+            answer = await asyncio.wait_for(future, self.timeout)
+        except (OSError, ConnectionError, websockets.ConnectionClosed):
+            # the reader may not have noticed yet: never retry on this connection
+            await self._drop(ws)
+            raise
+        finally:
+            pending.pop(request_id, None)
+        if "error" in answer:
+            raise RpcError(f"{method}: {answer['error']}")
+        return answer["result"]
+
+    async def request(self, method, params):
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                await self._wait_rate_limit()
+                try:
+                    return await self._request_once(method, params)
+                except (OSError, ConnectionError, asyncio.TimeoutError, websockets.WebSocketException, RpcError) as e:
+                    if attempt == self.retries:
+                        raise
+                    wait = self.backoff * 2**attempt * (1 + random.random())
+                    logging.info(f"   RPC {method} failed ({e}), retry in {wait:.1f} sec")
+                    await asyncio.sleep(wait)
+
+
+async def fetch_era_reward_points(client, substrate, cur_era, wave=16):
+    """
+    Fetch Staking.ErasRewardPoints concurrently, walking back from cur_era in waves of eras
+    until an era without points is found (eras older than the history depth are empty).
+
+    Returns a dataframe with columns address, points, era.
+    """
+    async def fetch(era):
+        storage_key = substrate.create_storage_key("Staking", "ErasRewardPoints", [era])
+        result = await client.request("state_getStorage", [storage_key.to_hex()])
+        data = ScaleBytes(result) if result is not None else None
+        return storage_key.decode_scale_value(data).value
+
+    dfs = []
+    era = cur_era
+    while True:
+        eras = list(range(era, max(era - wave, -1), -1))
+        results = await asyncio.gather(*(fetch(e) for e in eras))
+        for e, result in zip(eras, results):
+            if result['total'] == 0:
+                if e == cur_era:  # The current era might now have started yet?
+                    continue
+                logging.info(f"Fetch ended at era {e}")
+                return pd.concat(dfs).reset_index(drop=True)
+            df_e = pd.DataFrame.from_records([list(i) for i in result['individual']], columns=['address', 'points'])
+            df_e['era'] = e
+            dfs.append(df_e)
+        era = eras[-1] - 1
+        if era < 0:
+            return pd.concat(dfs).reset_index(drop=True)
+
+
+async def fetch_active_validators(client, substrate, eras, page_size=1000):
+    """
+    Fetch the validators in Staking.ErasStakersOverview for each era concurrently.
+
+    Only the storage keys are needed: the validator account is the last 32 bytes of the key
+    (Twox64Concat hasher). Returns a dict era -> list of ss58 addresses.
+    """
+    async def fetch(era):
+        prefix = substrate.create_storage_key("Staking", "ErasStakersOverview", [era]).to_hex()
+        validators = []
+        start_key = prefix
+        while True:
+            keys = await client.request("state_getKeysPaged", [prefix, page_size, start_key])
+            validators += [ss58_encode(key[-64:], substrate.ss58_format) for key in keys]
+            if len(keys) < page_size:
+                return validators
+            start_key = keys[-1]
+
+    results = await asyncio.gather(*(fetch(era) for era in eras))
+    return dict(zip(eras, results))
+
+
+def _run(coroutine_function, url, client_kwargs, *args):
+    async def main():
+        async with AsyncRpcClient(url, **client_kwargs) as client:
+            return await coroutine_function(client, *args)
+    return asyncio.run(main())
+
+
+def get_era_reward_points(url, substrate, cur_era, **client_kwargs):
+    """Blocking version of fetch_era_reward_points, see AsyncRpcClient for the client options."""
+    return _run(fetch_era_reward_points, url, client_kwargs, substrate, cur_era)
+
+
+def get_active_validators(url, substrate, eras, **client_kwargs):
+    """Blocking version of fetch_active_validators, see AsyncRpcClient for the client options."""
+    return _run(fetch_active_validators, url, client_kwargs, substrate, eras)
@@ -0,0 +1,67 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Store of the 1kv scores aligned to eras (see align_scores_1kv_to_era), written by make_score_figures.py.
+
+The store is a directory with .npy files:
+    scores.npy   -- float32 tensor (score field x stash x era), NaN before the first value of a stash
+    updates.npy  -- bool tensor of the same shape, True if the 1kv backend gave a new value in that era
+    fields.npy   -- the score fields of the first axis (e.g. score.inclusion)
+    stashes.npy  -- the stash addresses of the second axis
+    eras.npy     -- the eras (int64) of the third axis, increasing
+
+The tensors are read memory mapped: the values of one validator for one field are one contiguous
+run of eras, so only the pages of the validators that are used are read from disk.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+SCORES_FILE = "scores.npy"
+UPDATES_FILE = "updates.npy"
+FIELDS_FILE = "fields.npy"
+STASHES_FILE = "stashes.npy"
+ERAS_FILE = "eras.npy"
+
+
+def _save_atomic(path, array):
+    tmp = path.with_name(path.name + ".tmp.npy")
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def write_score_tensor(tensor_dir, scores, updates, fields, stashes, eras):
+    tensor_dir.mkdir(parents=True, exist_ok=True)
+    # The index files first: a reader detects a mismatch until the tensors are replaced as well
+    _save_atomic(tensor_dir / FIELDS_FILE, np.asarray(fields, dtype=str))
+    _save_atomic(tensor_dir / STASHES_FILE, np.asarray(stashes, dtype=str))
+    _save_atomic(tensor_dir / ERAS_FILE, np.asarray(eras, dtype=np.int64))
+    _save_atomic(tensor_dir / UPDATES_FILE, np.ascontiguousarray(updates, dtype=bool))
+    _save_atomic(tensor_dir / SCORES_FILE, np.ascontiguousarray(scores, dtype=np.float32))
+
+
+def read_score_tensor(tensor_dir, mmap=True):
+    """
+    Read the score store. Returns (scores, updates, fields, stashes, eras) with fields a list and stashes a pd.Index.
+    """
+    mmap_mode = "r" if mmap else None
+    scores = np.load(tensor_dir / SCORES_FILE, mmap_mode=mmap_mode)
+    updates = np.load(tensor_dir / UPDATES_FILE, mmap_mode=mmap_mode)
+    fields = np.load(tensor_dir / FIELDS_FILE).tolist()
+    stashes = pd.Index(np.load(tensor_dir / STASHES_FILE).astype(object))
+    eras = np.load(tensor_dir / ERAS_FILE)
+    shape = (len(fields), len(stashes), len(eras))
+    if scores.shape != shape or updates.shape != shape:
+        raise ValueError(f"Inconsistent score store in {tensor_dir}: {scores.shape} and {updates.shape} vs {shape}.")
+    return scores, updates, fields, stashes, eras
+
+
+def score_tensor_to_frames(scores, updates, fields, stashes, eras):
+    """
+    The dicts score field -> wide dataframe (index address, columns era) of align_scores_1kv_to_era,
+    as in the old scores_1kv_era.p and scores_1kv_era_update.p pickles. Useful in notebooks.
+    """
+    scores_1kv_era = {f: pd.DataFrame(np.asarray(scores[i], dtype=float), index=stashes, columns=eras) for i, f in enumerate(fields)}
+    scores_1kv_era_update = {f: pd.DataFrame(np.asarray(updates[i]), index=stashes, columns=eras) for i, f in enumerate(fields)}
+    return scores_1kv_era, scores_1kv_era_update
@@ -7,50 +7,69 @@ import matplotlib.pyplot as plt
 import matplotlib.style as mplstyle
 from matplotlib.ticker import MaxNLocator
 from matplotlib.ticker import ScalarFormatter
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scores_1kv_config import *
+from snapshots_1kv import read_1kv_snapshots
 from time import sleep
+import hashlib
+import json
+import os
 
 def read_1kv_json(json_dir, oldest_datetime=-1):
     """
     Read dumped json files from the 1kv backend. All date is from json except datetime is the exact datetime of the dump.
     
     Only use json files that are newer than oldest_datetime (if not -1)
+
+    Full and delta encoded snapshots are both rebuilt, see snapshots_1kv.py.
+    """
+    return read_1kv_snapshots(json_dir, None, oldest_datetime=oldest_datetime)
+
+def _max_points_per_era(df_s):
+    """
+    Merge era point frames in one pass. Detect same era address and take max (this can happen if era 
+    was not finished yet when querying chain).
     """
-    df_s = []
-    for f in list(json_dir.glob('*.feather')):
-        datetime = f.stem
-        if int(datetime)>=oldest_datetime:
-            # print(f"Reading {datetime}")                    
-            df = pd.read_feather(f)
-            df['dump.datetime'] = pd.to_datetime(datetime, unit='s')
-            # df['dump.datetime'] = datetime
-            df = df.reset_index(drop=True)
-            df_s.append(df)
-        # else:
-        #     print(f"Skipped {datetime}")
-
-    df_all = pd.concat(df_s).reset_index(drop=True)
-    df_all['score.datetime'] = pd.to_datetime(df_all['score.updated'], unit='ms')
-    return df_all 
+    df_all = pd.concat(df_s, ignore_index=True)
+    # From https://stackoverflow.com/a/40629420 - cool trick to select only max points 
+    df_all = df_all.sort_values('points', ascending=False, kind="stable").drop_duplicates(['address','era'], keep="first")
+    return df_all.sort_values(["address", "era"]).reset_index(drop=True)
 
 def read_onchain_erareward_files(era_tmp_dir):
     """
     Read on-chain reward points that were dumped as feather files by active_eras.py
     """
-    first = True    
-    for f in sorted(era_tmp_dir.glob("*.feather")):    
-        df_f = pd.read_feather(f)
-        if first:
-            df_all = df_f
-            first = False
-        else:
-            df_all = pd.concat([df_all, df_f], ignore_index=True).drop_duplicates().reset_index(drop=True)
-            # Detect same era address and take max (this can happen if era was not finished yet when querying chain)
-            # From https://stackoverflow.com/a/40629420 - cool trick to select only max points 
-            df_all = df_all.sort_values('points', ascending=False).drop_duplicates(['address','era'], keep="first")
-            
-            df_all = df_all.sort_values(["address", "era"])
-            # print(f"Number of rows: {len(df_all)}")
+    return _max_points_per_era([pd.read_feather(f) for f in sorted(era_tmp_dir.glob("*.feather"))])
+
+def update_onchain_erareward_store(era_tmp_dir, store_file):
+    """
+    Same as read_onchain_erareward_files but the merged (address, era) -> max(points) frame is kept in store_file.
+    Only the files in era_tmp_dir that are new (or rewritten) since the last call are read and merged.
+    The merged files are listed in a second file next to store_file with their size and modification time.
+    """
+    files_file = store_file.with_name(store_file.stem + "_files.feather")
+    files = pd.DataFrame.from_records(
+        [(f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in sorted(era_tmp_dir.glob("*.feather"))], 
+        columns=["file", "size", "mtime"])
+
+    if store_file.exists() and files_file.exists():
+        df_s = [pd.read_feather(store_file)]
+        merged = pd.read_feather(files_file)
+        new_files = files.merge(merged, how="left", indicator=True)
+        new_files = new_files[new_files["_merge"] == "left_only"]["file"]
+    else:
+        df_s = []
+        new_files = files["file"]
+
+    if df_s and len(new_files) == 0:
+        return df_s[0]
+
+    df_s += [pd.read_feather(era_tmp_dir / f) for f in new_files]
+    df_all = _max_points_per_era(df_s)
+    df_all.to_feather(store_file)
+    # written last: if we crash in between, the new files are merged again next time (which is harmless)
+    files.to_feather(files_file)
     return df_all
 
 def read_onchain_era_start_file(era_start_file):
@@ -63,26 +82,44 @@ def read_onchain_era_start_file(era_start_file):
     return df_start    
 
 
+def calc_window_inclusion(activity, eras, index, delta):
+    """
+    Sliding window inclusion from an (address x era) activity matrix with consecutive eras as columns.
+    The window sums over [era-delta+1, era] are computed at once from a cumulative sum along the era axis.
+
+    delta can be a single window size or a list of them (e.g. [84, 28]); in the latter case a dict 
+    delta -> dataframe is returned. Columns are the end eras, newest first, as in calc_inclusion_percentage.
+    """
+    if np.ndim(delta) > 0:
+        return {d: calc_window_inclusion(activity, eras, index, d) for d in delta}
+    eras = np.asarray(eras)
+    csum = np.zeros((activity.shape[0], activity.shape[1] + 1))
+    np.cumsum(activity, axis=1, out=csum[:, 1:])
+    # column k of csum is the sum of the first k eras, so the window ending at era position j is csum[j+1] - csum[j+1-delta]
+    # (like before, the first complete window ending at position delta-1 is not included)
+    end_pos = np.arange(len(eras) - 1, delta - 1, -1)
+    pct = (csum[:, end_pos + 1] - csum[:, end_pos + 1 - delta]) / delta
+    return pd.DataFrame(pct, index=index, columns=eras[end_pos])
+
+
 def calc_inclusion_percentage(df_all, delta):
     """
     Calculate the percentage when validator was active for delta eras.
     Done for all eras in a sliding window [era-delta+1, era].    
+
+    The (address x era) activity matrix is built once and all windows follow from its cumulative sum.
+    delta can also be a list of window sizes, see calc_window_inclusion.
     """
-    # TODO: can be faster - calc from df_era and slice over all addresses (replace > = by True, and sum in window)
-    eras = df_all['era'].unique()
-    max_era = np.max(eras) 
-    min_era = np.min(eras)     
-    addr = df_all['address'].unique()
-        
-    pcts = []
-    for address in addr:
-        pct_cur = {"address": address}
-        df_cur = df_all[df_all['address'] == address]        
-        for end_era in range(max_era, min_era+delta-1, -1):          
-            pct_cur[end_era] = len( df_cur[(df_cur['era'] <= end_era) & (df_cur['era'] >= end_era-delta+1)] ) / delta
-        pcts.append(pct_cur)
+    codes, addr = pd.factorize(df_all['address'])
+    min_era = df_all['era'].min()
+    max_era = df_all['era'].max()
+    eras = np.arange(min_era, max_era + 1)
 
-    return pd.DataFrame(pcts).set_index("address", verify_integrity=True)
+    # number of rows per address and era (the eras in df_all are unique per address in practice)
+    activity = np.zeros((len(addr), len(eras)))
+    np.add.at(activity, (codes, df_all['era'].values - min_era), 1)
+
+    return calc_window_inclusion(activity, eras, pd.Index(addr, name="address"), delta)
 
 
 def calc_inclusion_scores(df_incl, LOW_Q=0.20, UPP_Q=0.75, SCORE_WEIGHT=100):
@@ -110,46 +147,45 @@ def replace_era_by_timestamp(df, known_era, known_time, DURATION_EPOCH):
     return df_new
 
 
+def align_scores_1kv_to_era(df_1kv, score_fields, df_eras_start_end, stash_1kv):
+    """
+    Extract the score fields from df_1kv dataframe, align to an era and forward fill the gaps.
+    Performed for all addresses in stash_1kv and all score fields in one pass.
+
+    Returns two dicts score_field -> wide dataframe (index address, columns era): the aligned scores
+    and whether the score was updated in that era.
+    """
+    score_1kv = df_1kv[["stash", "score.datetime"] + list(score_fields)].dropna(subset=["score.datetime"])
+    score_1kv = score_1kv.sort_values("score.datetime", kind="stable")
+
+    # the eras that we want to match with: first era that ends after the score (merge_asof forward)
+    tmp_eras_end = df_eras_start_end.sort_values(by="end")
+    eras_end = tmp_eras_end["end"].values.astype("datetime64[ns]")
+    pos = np.searchsorted(eras_end, score_1kv["score.datetime"].values.astype("datetime64[ns]"), side="left")
+    in_era = pos < len(eras_end)
+    score_1kv = score_1kv[in_era].assign(era=tmp_eras_end["era"].values[pos[in_era]])
+
+    # take most recent value in era when multiple values (last skips the missing values of each field)
+    last_1kv = score_1kv.groupby(["stash", "era"], sort=False)[list(score_fields)].last()
+
+    eras = pd.Index(np.sort(df_eras_start_end["era"].values), name="era")
+    addresses = pd.Index(stash_1kv, name="address")
+    scores_era = {}
+    scores_era_update = {}
+    for score_field in score_fields:
+        # fill in blanks in eras for each score by using last updated entry
+        tmp = last_1kv[score_field].unstack("era").reindex(index=addresses, columns=eras)
+        scores_era_update[score_field] = tmp.notna()
+        scores_era[score_field] = tmp.ffill(axis=1)
+    return scores_era, scores_era_update
+
 def align_score_1kv_to_era(df_1kv, score_field, df_eras_start_end, stash_1kv):
     """
     Extract one score field from df_1kv dataframe, align to an era and forward fill the gaps.
     Performed for all addresses in stash_1kv.
     """
-    score_1kv = df_1kv[["stash", score_field, "score.datetime"]].drop_duplicates().sort_values("score.datetime") 
-    score_1kv = score_1kv.rename(columns={score_field: "SCORE", "score.datetime": "datetime"})
-
-    # the eras that we want to match with
-    tmp_eras_end = df_eras_start_end.rename(columns={"end": "datetime"})
-    tmp_eras_end = tmp_eras_end.sort_values(by="datetime")
-
-    tmp_eras = df_eras_start_end["era"].sort_values().values
-    tmp_eras = pd.DataFrame({"era": tmp_eras}).set_index("era")
-    tmp_eras["score"] = -1
-
-    pcts = []
-    updates= []
-    for address in stash_1kv:
-        
-        tmp_1kv = score_1kv.query("stash==@address").dropna().sort_values(by="datetime")
-        tmp_1kv_era = pd.merge_asof(tmp_1kv, tmp_eras_end, on="datetime", direction="forward")    
-        
-        # fill in blanks in eras for each score by using last updated entry
-        tmp = tmp_1kv_era[["SCORE", "era"]].set_index("era")        
-        tmp = tmp[~tmp.index.duplicated(keep='last')] # take most recent value in era when multiple values      
-        tmp = tmp_eras.join(tmp).drop(columns=["score"])
-        tmp2 = tmp.copy()
-        tmp2["updated"] = ~tmp2["SCORE"].isna()
-        tmp2 = tmp2.drop(columns=["SCORE"])
-        tmp2["address"] = address
-        tmp = tmp.fillna(method="ffill")    
-        tmp["address"] = address
-        tmp = tmp.reset_index().pivot(index="address", columns="era", values="SCORE")
-        tmp2 = tmp2.reset_index().pivot(index="address", columns="era", values="updated")
-
-        pcts.append(tmp)
-        updates.append(tmp2)
-
-    return pd.concat(pcts), pd.concat(updates)
+    scores_era, scores_era_update = align_scores_1kv_to_era(df_1kv, [score_field], df_eras_start_end, stash_1kv)
+    return scores_era[score_field], scores_era_update[score_field]
 
 def recompute_score_from_quantile(chain, last_1kv, field, with_blacklist):
     """
@@ -198,85 +234,433 @@ def recompute_score_from_quantile(chain, last_1kv, field, with_blacklist):
     return (last_field, last_1kv) 
 
 
+def score_input_columns(chain):
+    """
+    The columns of the candidates dump used by theoretical_scores.
+    """
+    return list(dict.fromkeys(c for rule in score_rules[chain].values() for c in rule["inputs"]))
+
+def _scale_between(values, low, upp):
+    """
+    As calc_inclusion_scores: 0 at or below low, 1 at or above upp, linear in between (NaN stays NaN).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = (values - low) / (upp - low)
+    scaled = np.where(values <= low, 0.0, scaled)
+    return np.where(values >= upp, 1.0, scaled)
+
+def _score_components(chain, last_1kv, bounds=None):
+    """
+    The (validator x field) values and quantile bounds of the fields of score_rules that have their inputs 
+    in last_1kv, and the scaled components (1 is the best score). bounds (a dict field -> [lower, upper] 
+    quantile) overrides quantile_bounds.
+    """
+    rules = {f: r for f, r in score_rules[chain].items() if all(c in last_1kv.columns for c in r["inputs"])}
+    fields = list(rules)
+    blacklisted = last_1kv["provider"].isin(blacklist_provider[chain]).to_numpy()
+    bounds = {**quantile_bounds[chain], **(bounds or {})}
+
+    # (validator x field) values and the quantile bounds of each field
+    values = np.full((len(last_1kv), len(fields)), np.nan)
+    levels_q = np.array([bounds[f] for f in fields], dtype=float).reshape(-1, 2)
+    low = np.full(len(fields), np.nan)
+    upp = np.full(len(fields), np.nan)
+    distinct = {}
+    for j, f in enumerate(fields):
+        inputs = last_1kv[rules[f]["inputs"]]
+        if rules[f].get("rule") == "count":
+            col = inputs.iloc[:, 0].replace("", "(empty)")
+            distinct[f] = col.value_counts()
+            values[:, j] = col.map(distinct[f]).to_numpy(dtype=float)
+            # quantiles over the distinct values, not over the validators
+            low[j], upp[j] = np.quantile(distinct[f].to_numpy(dtype=float), levels_q[j])
+        elif rules[f].get("rule") == "sqrt":
+            values[:, j] = np.sqrt(inputs.to_numpy(dtype=float)).sum(axis=1)
+        else:
+            values[:, j] = inputs.iloc[:, 0].to_numpy(dtype=float)
+
+    # the quantiles of all other fields in one call
+    other = np.array([j for j, f in enumerate(fields) if rules[f].get("rule") != "count"], dtype=int)
+    if len(other) > 0:
+        levels = np.unique(levels_q[other])
+        quant = np.nanquantile(values[:, other], levels, axis=0)
+        low[other] = quant[np.searchsorted(levels, levels_q[other, 0]), np.arange(len(other))]
+        upp[other] = quant[np.searchsorted(levels, levels_q[other, 1]), np.arange(len(other))]
+
+    higher_better = np.array([rules[f]["higher_better"] for f in fields], dtype=bool)
+    with_blacklist = np.array([rules[f].get("blacklist", False) for f in fields], dtype=bool)
+    scaled = _scale_between(values, low, upp)
+    components = np.where(higher_better, scaled, 1 - scaled)
+    components[np.ix_(blacklisted, with_blacklist)] = 0.0
+    return {"rules": rules, "fields": fields, "values": values, "low": low, "upp": upp, "distinct": distinct, 
+            "higher_better": higher_better, "with_blacklist": with_blacklist, "blacklisted": blacklisted, 
+            "components": components}
+
+def score_components(chain, last_1kv, bounds=None):
+    """
+    The recomputed score of each validator (rows, index of last_1kv) and field (columns) of score_rules without 
+    its weight: between 0 and 1, 1 is the best. bounds (a dict field -> [lower, upper] quantile) overrides 
+    quantile_bounds. Fields without their inputs in last_1kv are left out.
+    """
+    c = _score_components(chain, last_1kv, bounds)
+    return pd.DataFrame(c["components"], index=last_1kv.index, columns=c["fields"])
+
+def theoretical_scores(chain, last_1kv):
+    """
+    Recompute the scores of all fields of score_rules (that have their inputs in last_1kv) with the quantile 
+    rule of calc_inclusion_scores, for all validators at once.
+
+    Returns (th, counts): th a dataframe with the index of last_1kv and columns th-score.<field> (and <field>.count 
+    for the count rule), counts a dict field -> dataframe with the count and score of each distinct value (as in 
+    recompute_score_from_quantile).
+    """
+    c = _score_components(chain, last_1kv)
+    fields = c["fields"]
+    weights = np.array([score_weights[chain][f] for f in fields])
+    th = pd.DataFrame(np.round(c["components"] * weights, 2), index=last_1kv.index, columns=[f"th-score.{f}" for f in fields])
+
+    counts = {}
+    for j, f in enumerate(fields):
+        if f not in c["distinct"]:
+            continue
+        th[f"{f}.count"] = c["values"][:, j]
+        scaled = _scale_between(c["distinct"][f].to_numpy(dtype=float), c["low"][j], c["upp"][j])
+        score = np.round((scaled if c["higher_better"][j] else 1 - scaled) * weights[j], 2)
+        last_field = pd.DataFrame({f: c["distinct"][f].index, "count": c["distinct"][f].to_numpy(), "score": score})
+        col = last_1kv[c["rules"][f]["inputs"][0]].replace("", "(empty)")
+        last_field["blacklist"] = last_field[f].map(pd.Series(c["blacklisted"], index=last_1kv.index).groupby(col).min())
+        if c["with_blacklist"][j]:
+            last_field.loc[last_field["blacklist"], "score"] = 0.0
+        counts[f] = last_field
+    return th, counts
+
+
+# Quantiles of the delay of the 1kv scores over the stashes, per era
+DELAY_QUANTILE_LEVELS = np.array([0.9, 0.75, 0.5, 0.25, 0.1])
+
+def calc_delay_per_era(all_last_1kv):
+    """
+    Delay of the scores by the 1kv backend (dump time - score time) for the eras in all_last_1kv.
+    Multiple values per era: take the minimal one per stash to get an optimistic value.
+
+    Returns (delay_score_backend, delay_score_backend_quantiles) with the eras in order of appearance
+    and the stashes sorted within an era.
+    """
+    tmp = pd.DataFrame({"stash": all_last_1kv["stash"].values, 
+                        "diff": pd.to_timedelta(all_last_1kv["dump.datetime"] - all_last_1kv["score.datetime"]).values,
+                        "era": all_last_1kv["era"].values})
+    eras = pd.Index(tmp["era"].unique())
+
+    delay = tmp.groupby(["era", "stash"])["diff"].min().reset_index()
+    delay = delay.iloc[np.argsort(eras.get_indexer(delay["era"]), kind="stable")]
+    delay = delay[["stash", "diff", "era"]].reset_index(drop=True)
+
+    quantiles = delay.groupby("era", sort=False)["diff"].quantile(DELAY_QUANTILE_LEVELS)
+    quantiles = pd.DataFrame({"quantiles.levels": np.tile(DELAY_QUANTILE_LEVELS, len(eras)),
+                              "quantiles.values": quantiles.values,
+                              "era": quantiles.index.get_level_values(0).values})
+    quantiles["hours"] = quantiles["quantiles.values"] / np.timedelta64(1, 'h') # trick to get hours
+    return delay, quantiles
+
+
 ### FIGURES    
-def make_figs_active(active_eras, address, save_dir=None):    
-    # Setup plot configuration and data
-    plt.rcParams.update({'font.size': 16})
-    if save_dir:
-        matplotlib.use('agg')
-    columns_list = active_eras.columns[1:].tolist()
+# Change when the look of the figures changes, so all cached figures are rendered again
+RENDER_STYLE_VERSION = 1
 
+class FigureRenderer:
+    """
+    Renders the per-address line figures without pyplot.
 
+    For each kind of figure (e.g. a score field) one Agg figure with its title, limits and grid is 
+    built once; for each address only the data of the line and the markers is swapped. The layout 
+    (tight_layout) is only recomputed for an x range that was not seen before.
 
-    if address in active_eras['index'].values:
-        # Copy the activity values of the eras
-        validator_row = active_eras[active_eras['index'] == address]
-        row_list = validator_row.iloc[0, 1:].tolist()
+    specs is a dict name -> dict with "title", "ylim" and optionally "ylabel" and "yticks".
 
-        # Convert to a list of integers
-        activity = [int(i) for i in row_list]
-    else:
-        activity = [0] * len(columns_list)
-    update_eras =  list(map(int, columns_list))
-    # Create line plot for the activity
-    fig, ax = plt.subplots(figsize=(8, 4.8))
-    ax.plot(update_eras, activity, 'b-')  # Blue line for activity status
+    cache is a dict file name -> hash of the inputs of that figure (see read_render_cache). A figure 
+    whose file exists and whose data, bounds and style did not change is not rendered again, so its
+    file and modification time stay as they are. The hashes of all rendered or skipped figures are
+    collected in self.hashes.
+    """
+    def __init__(self, specs, cache=None):
+        matplotlib.rcParams.update({'font.size': 16})
+        self.cache = cache if cache is not None else {}
+        self.hashes = {}
+        self._spec_keys = {name: f"{RENDER_STYLE_VERSION} {matplotlib.__version__} {sorted(spec.items())}" for name, spec in specs.items()}
+        # tight_layout depends slightly on the layout it starts from, so always start from the one of a new figure
+        pars = Figure().subplotpars
+        self._new_layout = dict(left=pars.left, right=pars.right, bottom=pars.bottom, top=pars.top)
+        self._figs = {}
+        for name, spec in specs.items():
+            fig = Figure(figsize=(8,4.8))
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            line, = ax.plot([], [], 'b-')
+            markers, = ax.plot([], [], 'bo')
+            ax.set_ylim(spec["ylim"])
+            if "yticks" in spec:
+                ax.set_yticks(spec["yticks"])
+            ax.set_title(spec["title"])
+            if "ylabel" in spec:
+                ax.set_ylabel(spec["ylabel"])
+            ax.grid(True)
+            self._figs[name] = (fig, ax, line, markers, {})
+
+        # x limits of a new figure without any data to show
+        ax = Figure().add_subplot()
+        ax.plot([np.nan], [np.nan])
+        self._empty_xlim = ax.get_xlim()
+
+    def _digest(self, name, *data):
+        h = hashlib.blake2b(self._spec_keys[name].encode(), digest_size=16)
+        for array in data:
+            array = np.ascontiguousarray(array, dtype=float)
+            h.update(str(array.shape).encode())
+            h.update(array.tobytes())
+        return h.hexdigest()
+
+    def render(self, name, x, y, x_markers, y_markers, path=None):
+        """
+        Swap in the data and save to path (if not None). Returns the figure, which is reused by the next call,
+        or None if the file is up to date.
+        """
+        if path is not None:
+            digest = self._digest(name, x, y, x_markers, y_markers)
+            self.hashes[path.name] = digest
+            if self.cache.get(path.name) == digest and path.exists():
+                return None
+
+        fig, ax, line, markers, layouts = self._figs[name]
+        line.set_data(x, y)
+        markers.set_data(x_markers, y_markers)
+        # same x limits as autoscaling a new figure (missing values are ignored)
+        if np.isfinite(np.asarray(y, dtype=float)).any() or np.isfinite(np.asarray(y_markers, dtype=float)).any():
+            ax.set_autoscalex_on(True)
+            ax.relim()
+            ax.autoscale_view(scaley=False)
+        else:
+            ax.set_xlim(self._empty_xlim)
+        xlim = ax.get_xlim()
+        if xlim not in layouts:
+            fig.subplots_adjust(**self._new_layout)
+            fig.tight_layout()
+            pars = fig.subplotpars
+            layouts[xlim] = dict(left=pars.left, right=pars.right, bottom=pars.bottom, top=pars.top)
+        else:
+            fig.subplots_adjust(**layouts[xlim])
+        if path is not None:
+            savefig_replace(fig, path)
+        return fig
 
 
-    ax.plot(update_eras, activity, 'bo')  # Blue points for updates
+def savefig_replace(fig, path):
+    """
+    Save fig as png in path. The file is replaced and not rewritten in place, so published links of the old 
+    figure stay intact and readers never see a half written figure (see publish.py).
+    """
+    tmp = path.with_name(f".{path.name}.tmp")
+    fig.savefig(tmp, dpi=75, facecolor='white', transparent=False, format="png")
+    os.replace(tmp, path)
 
-    # Set bounds for y-axis, assuming the scores are binary (0 or 1)
-    bound_scores = [0, 1]
-    ax.set_ylim([bound_scores[0] - 0.05 * (bound_scores[1] - bound_scores[0]), 
-                bound_scores[1] + 0.05 * (bound_scores[1] - bound_scores[0])])
 
-    # Configure y-ticks to only show integers 0 and 1
-    ax.set_yticks([0, 1])
+def read_render_cache(cache_file):
+    """
+    Hashes of the figures rendered in a previous run, grouped per address: address -> {file name: hash}.
+    """
+    if not cache_file.exists():
+        return {}
+    with open(cache_file) as f:
+        hashes = json.load(f)
+    cache = {}
+    for file_name, digest in hashes.items():
+        cache.setdefault(file_name.split("_")[0], {})[file_name] = digest
+    return cache
 
-    # Set titles and labels
-    ax.set_title("Validator Activity Over Eras")
-    ax.set_ylabel("Active (1) or Inactive (0)")
-    ax.grid(True)
 
+def write_render_cache(cache_file, hashes_list):
+    """
+    Store the hashes (list of dicts file name -> hash, one per batch) of the figures of this run.
+    """
+    hashes = {}
+    for h in hashes_list:
+        hashes.update(h)
+    tmp = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(hashes, f)
+    os.replace(tmp, cache_file)
 
-    # Adjust layout for better visibility
-    plt.tight_layout()
-    if save_dir:
-        fig.savefig(save_dir / f"{address}_era_activity.png", dpi=75, facecolor='white', transparent=False)            
-        plt.close(fig)    
 
+def batch_render_cache(cache, addresses):
+    """
+    The part of the cache (from read_render_cache) for a batch of addresses.
+    """
+    return {file_name: digest for address in addresses for file_name, digest in cache.get(address, {}).items()}
 
-def make_figs_all_scores(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, address, save_dir=None):    
-    plt.rcParams.update({'font.size': 16})
-    if save_dir:
-        matplotlib.use('agg')
-    
-    # mplstyle.use(['ggplot', 'fast']) # uglier on ggplot is uglier on screen
+
+# Set bounds for y-axis, assuming the scores are binary (0 or 1), and only show integers 0 and 1
+ACTIVITY_FIGURE_SPECS = {"activity": {"title": "Validator Activity Over Eras",
+                                      "ylabel": "Active (1) or Inactive (0)",
+                                      "ylim": [-0.05, 1.05],
+                                      "yticks": [0, 1]}}
+
+def score_figure_specs(descr_scores, bound_scores):
+    """
+    FigureRenderer specs for the score fields.
+    """
+    specs = {}
+    for score in descr_scores.keys():
+        bnd = bound_scores[score]
+        specs[score] = {"title": descr_scores[score], "ylim": bnd + np.array([-0.05, 0.05])*(bnd[1]-bnd[0])}
+    return specs
+
+
+def make_figs_active(activity, stashes, eras, address, save_dir=None, renderer=None):    
+    """
+    Activity figure from the (stash x era) activity matrix, see activity_matrix.py.
+    Pass a FigureRenderer made with ACTIVITY_FIGURE_SPECS to reuse it over many addresses.
+    """
+    if renderer is None:
+        renderer = FigureRenderer(ACTIVITY_FIGURE_SPECS)
+
+    row = stashes.get_indexer([address])[0]
+    if row >= 0:
+        # The activity values of the eras (a view on the matrix)
+        activity = activity[row]
+    else:
+        activity = np.zeros(len(eras), dtype=np.uint8)
+
+    # Line for activity status, points for updates
+    path = save_dir / f"{address}_era_activity.png" if save_dir else None
+    return renderer.render("activity", eras, activity, eras, activity, path)
+
+
+def make_figs_active_batch(activity, stashes, eras, addresses, save_dir, cache=None):
+    """
+    make_figs_active for a batch of addresses with one renderer (one parallel task).
+    Returns the hashes of the figures, see FigureRenderer.
+    """
+    renderer = FigureRenderer(ACTIVITY_FIGURE_SPECS, cache)
+    for address in addresses:
+        make_figs_active(activity, stashes, eras, address, save_dir, renderer)
+    return renderer.hashes
+
+
+def make_figs_all_scores(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, address, save_dir=None, renderer=None):    
+    """
+    Score history figures of one address, for all fields in descr_scores.
+    Pass a FigureRenderer made with score_figure_specs to reuse it over many addresses.
+    """
+    if renderer is None:
+        renderer = FigureRenderer(score_figure_specs(descr_scores, bound_scores))
 
     for score in descr_scores.keys():        
-        fig = plt.figure(figsize=(8,4.8))
-        # fig, ax = plt.subplots(1, 1, figsize=(8,4.8))
-        
         x = scores_1kv_era[score].loc[address].index.values
         y = scores_1kv_era[score].loc[address].values
-        plt.plot(x,y,'b-')
         x_up = scores_1kv_era_update[score].loc[address].index.values
         y_up = scores_1kv_era_update[score].loc[address].values
 
         updated_era = x_up[y_up]
         updated_score = y[y_up]
-        plt.plot(updated_era,updated_score,'bo')
-        bnd = bound_scores[score]
-        plt.ylim(bnd + np.array([-0.05, 0.05])*(bnd[1]-bnd[0]))
-        plt.grid(True)
-
-        plt.title(descr_scores[score])
-        plt.tight_layout()
+        path = None
         if save_dir:
             tmp_score = score.replace(".", "-")
-            fig.savefig(save_dir / f"{address}_era_{tmp_score}.png", dpi=75, facecolor='white', transparent=False)
-            
-            plt.close(fig)    
+            path = save_dir / f"{address}_era_{tmp_score}.png"
+        renderer.render(score, x, y, updated_era, updated_score, path)
+
+
+def make_figs_all_scores_batch(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, addresses, save_dir, cache=None):
+    """
+    make_figs_all_scores for a batch of addresses with one renderer (one parallel task).
+    Returns the hashes of the figures, see FigureRenderer.
+    """
+    renderer = FigureRenderer(score_figure_specs(descr_scores, bound_scores), cache)
+    for address in addresses:
+        make_figs_all_scores(scores_1kv_era, scores_1kv_era_update, descr_scores, bound_scores, address, save_dir, renderer)
+    return renderer.hashes
+
+
+def score_arrays(scores_1kv_era, scores_1kv_era_update, fields):
+    """
+    Dense arrays of the score frames of align_scores_1kv_to_era: (scores, updates, stashes, eras)
+    with scores a float (field x stash x era) array, updates the bool mask of the same shape.
+    """
+    stashes = scores_1kv_era[fields[0]].index
+    eras = scores_1kv_era[fields[0]].columns
+    scores = np.stack([scores_1kv_era[f].reindex(index=stashes, columns=eras).to_numpy(dtype=float) for f in fields])
+    updates = np.stack([scores_1kv_era_update[f].reindex(index=stashes, columns=eras, fill_value=False).to_numpy(dtype=bool) for f in fields])
+    return scores, updates, stashes, eras.to_numpy()
+
+
+def make_figs_scores_rows(scores, updates, eras, descr_scores, bound_scores, rows, addresses, save_dir, cache=None):
+    """
+    make_figs_all_scores_batch on the arrays of score_arrays (fields in the order of descr_scores).
+    Only the rows of the addresses are read, so memory mapped arrays are shared with the workers
+    instead of being pickled. Returns the hashes of the figures, see FigureRenderer.
+    """
+    renderer = FigureRenderer(score_figure_specs(descr_scores, bound_scores), cache)
+    for row, address in zip(rows, addresses):
+        for i, score in enumerate(descr_scores.keys()):
+            y = np.asarray(scores[i, row])
+            updated = np.asarray(updates[i, row])
+            tmp_score = score.replace(".", "-")
+            renderer.render(score, eras, y, eras[updated], y[updated], save_dir / f"{address}_era_{tmp_score}.png")
+    return renderer.hashes
+
+
+### CHART DATA
+# "png": one figure per address and field (FigureRenderer). "data": one json per chain and field
+# with the data of all addresses, the charts are drawn in the browser (doks shortcode score-chart).
+FIGURE_MODE = "png"
+
+def _write_json_atomic(data, path):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def chart_data_scores(scores, updates, stashes, eras, descr_scores, bound_scores, save_dir):
+    """
+    Write the score history of all addresses as one file <field>.json per score field (e.g. score-inclusion.json).
+    scores and updates are the (field x stash x era) arrays of score_arrays or the score store (fields in 
+    the order of descr_scores).
+
+    Only the updates are stored, in columnar form: the updates of the address stashes[i] are at
+    positions start[i]:start[i+1] of era (index into eras) and value. The line between updates
+    is the last value carried forward, as in align_scores_1kv_to_era.
+    """
+    save_dir.mkdir(parents=True, exist_ok=True)
+    specs = score_figure_specs(descr_scores, bound_scores)
+    for i, score in enumerate(descr_scores.keys()):
+        rows, cols = np.nonzero(updates[i])
+        data = {"title": specs[score]["title"],
+                "ylim": [float(v) for v in specs[score]["ylim"]],
+                "eras": [int(era) for era in eras],
+                "stashes": list(stashes),
+                "start": np.searchsorted(rows, np.arange(len(stashes) + 1)).tolist(),
+                "era": cols.tolist(),
+                "value": np.round(np.asarray(scores[i], dtype=float)[rows, cols], 3).tolist()}
+        _write_json_atomic(data, save_dir / f"{score.replace('.', '-')}.json")
+
+
+def chart_data_activity(activity, stashes, eras, addresses, save_dir):
+    """
+    Write the activity of addresses as activity.json: per address a hex string of the packed
+    bits (one per era, first era in the highest bit) of its row in the activity matrix.
+    """
+    save_dir.mkdir(parents=True, exist_ok=True)
+    rows = stashes.get_indexer(addresses)
+    bits = np.zeros((len(addresses), len(eras)), dtype=np.uint8)
+    bits[rows >= 0] = np.asarray(activity)[rows[rows >= 0]]
+    spec = ACTIVITY_FIGURE_SPECS["activity"]
+    data = {"title": spec["title"],
+            "ylabel": spec["ylabel"],
+            "ylim": spec["ylim"],
+            "yticks": spec["yticks"],
+            "eras": [int(era) for era in eras],
+            "stashes": list(addresses),
+            "bits": [row.tobytes().hex() for row in np.packbits(bits, axis=1)]}
+    _write_json_atomic(data, save_dir / "activity.json")
 
 
 def format_time_delta(timedelta):
@@ -324,7 +708,7 @@ def make_figs_delay_score_backend(delay_score_backend_quantiles, save_dir=None):
     ax = fig.gca()
     ax.xaxis.set_major_locator(MaxNLocator(integer=True))
     if save_dir:        
-        fig.savefig(save_dir / f"delay_score_backend.png", dpi=75, facecolor='white', transparent=False)            
+        savefig_replace(fig, save_dir / f"delay_score_backend.png")            
         plt.close(fig)  
 
 def make_hist_fig_delay_score_backend(delay_score_backend, era=None, save_dir=None):
@@ -357,6 +741,6 @@ def make_hist_fig_delay_score_backend(delay_score_backend, era=None, save_dir=No
     # ax.xaxis.set_major_formatter(ScalarFormatter())
 
     if save_dir:        
-        fig.savefig(save_dir / f"delay_score_backend_hist_era_{era}.png", dpi=75, facecolor='white', transparent=False)            
+        savefig_replace(fig, save_dir / f"delay_score_backend_hist_era_{era}.png")            
         plt.close(fig)   
 
@@ -167,6 +167,32 @@ quantile_bounds = {}
 quantile_bounds['kusama'] = _quantile_bounds.copy()
 quantile_bounds['polkadot'] = _quantile_bounds.copy()
 
+# How the 1kv backend scores a field from the candidates dump (see constraints.ts, scoreCandidate): the input 
+# columns, whether a higher value gives a higher score, and the special rules:
+#   "count": the value is the number of candidates that share it, quantiles over the distinct values (location, ...)
+#   "sqrt": the value is the sum of the square roots of the inputs (active and inactive nominator stake)
+#   "blacklist": zero score for a blacklisted provider
+# Fields whose input columns are not in the dump are not recomputed.
+_score_rules = {
+"inclusion": {"inputs": ["inclusion"], "higher_better": False},
+"spanInclusion": {"inputs": ["spanInclusion"], "higher_better": False},
+"discovered": {"inputs": ["discoveredAt"], "higher_better": False},
+"nominated": {"inputs": ["nominatedAt"], "higher_better": False},
+"rank": {"inputs": ["rank"], "higher_better": True},
+"bonded": {"inputs": ["bonded"], "higher_better": True},
+"faults": {"inputs": ["faults"], "higher_better": False},
+"offline": {"inputs": ["offlineAccumulated"], "higher_better": False},
+"nominatorStake": {"inputs": ["nominatorStake.activeStake", "nominatorStake.inactiveStake"], "higher_better": True, "rule": "sqrt"},
+"location": {"inputs": ["location"], "higher_better": False, "rule": "count"},
+"region": {"inputs": ["infrastructureLocation.region"], "higher_better": False, "rule": "count"},
+"country": {"inputs": ["infrastructureLocation.country"], "higher_better": False, "rule": "count"},
+"provider": {"inputs": ["provider"], "higher_better": False, "rule": "count", "blacklist": True},
+}
+
+score_rules = {}
+score_rules['kusama'] = _score_rules.copy()
+score_rules['polkadot'] = _score_rules.copy()
+
 # https://github.com/w3f/1k-validators-be/blob/47c1dbd4924d91c430b931d222d37ec90b1c9045/helmfile.d/config/polkadot/otv-backend-prod.yaml.gotmpl#L1309
 _blacklist_provider = ["Hetzner Online GmbH", "Contabo Inc.", "Contabo GmbH"]
 blacklist_provider = {}
@@ -0,0 +1,291 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+from pathlib import Path
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# The manifest lives next to the snapshots in 1kv_json/<chain> (not as *.feather so it is not
+# mistaken for a snapshot) and has one row per dump:
+#   datetime  -- unix time (sec) of the dump, also the stem of the file name
+#   file      -- file name relative to the snapshot dir
+#   kind      -- "full" for a complete snapshot (keyframe), "delta" for the changes w.r.t. the previous dump
+MANIFEST_FILE = "manifest.arrow"
+# Key of the delta description in the arrow schema metadata of a delta file
+DELTA_META_KEY = b"insights-1kv.delta"
+
+
+def _empty_manifest():
+    return pd.DataFrame({"datetime": pd.Series([], dtype="int64"),
+                         "file": pd.Series([], dtype="object"),
+                         "kind": pd.Series([], dtype="object")})
+
+
+def _scan_snapshot_dir(json_dir):
+    """
+    Index all snapshot files in json_dir by their file name. Only used when there is no manifest yet.
+    """
+    rows = [(int(f.stem), f.name, "full") for f in json_dir.glob("*.feather") if f.stem.isdigit()]
+    if not rows:
+        return _empty_manifest()
+    return pd.DataFrame.from_records(rows, columns=["datetime", "file", "kind"]).sort_values("datetime").reset_index(drop=True)
+
+
+def _write_atomic(df, path):
+    """
+    Write a feather file via a temporary file so readers in other services never see half a file.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    df.to_feather(tmp)
+    os.replace(tmp, path)
+
+
+def read_snapshot_manifest(json_dir):
+    """
+    Read the manifest of the dumped 1kv snapshots, sorted by dump datetime.
+
+    If the manifest does not exist yet (old dump directory), the directory is scanned once in memory.
+    The manifest itself is only written by the dumper (register_snapshot).
+    """
+    manifest_file = json_dir / MANIFEST_FILE
+    if manifest_file.exists():
+        manifest = pd.read_feather(manifest_file)
+        if "kind" not in manifest.columns:
+            manifest["kind"] = "full"
+        return manifest
+    return _scan_snapshot_dir(json_dir)
+
+
+def register_snapshot(json_dir, datetime, file_name, kind="full"):
+    """
+    Add a freshly written snapshot to the manifest of json_dir.
+    """
+    manifest = read_snapshot_manifest(json_dir)
+    manifest = manifest[manifest["datetime"] != datetime]
+    new = pd.DataFrame({"datetime": [int(datetime)], "file": [file_name], "kind": [kind]})
+    manifest = pd.concat([manifest, new]).sort_values("datetime").reset_index(drop=True)
+    _write_atomic(manifest, json_dir / MANIFEST_FILE)
+    return manifest
+
+
+def latest_snapshot_datetime(json_dir):
+    """
+    Unix time of the most recent dump, or None if nothing was dumped yet.
+    """
+    manifest = read_snapshot_manifest(json_dir)
+    if manifest.empty:
+        return None
+    return int(manifest["datetime"].max())
+
+
+def _same_cells(a, b):
+    """
+    Element-wise equality of two aligned columns where NaN equals NaN.
+    Object columns can hold lists or arrays from json_normalize, so they are compared cell by cell.
+    """
+    if a.dtype == object or b.dtype == object:
+        same = []
+        for x, y in zip(a.values, b.values):
+            if isinstance(x, (list, np.ndarray)) or isinstance(y, (list, np.ndarray)):
+                same.append(isinstance(x, (list, np.ndarray)) and isinstance(y, (list, np.ndarray))
+                            and np.array_equal(np.asarray(x, dtype=object), np.asarray(y, dtype=object)))
+            elif pd.isna(x) or pd.isna(y):
+                same.append(bool(pd.isna(x) and pd.isna(y)))
+            else:
+                same.append(bool(x == y))
+        return np.array(same, dtype=bool)
+    return ((a.values == b.values) | (a.isna().values & b.isna().values))
+
+
+def make_delta(prev, cur):
+    """
+    Encode snapshot cur relative to snapshot prev, keyed by stash.
+
+    Returns (delta, meta) where delta holds the changed and new rows restricted to the changed columns
+    (all columns if there are new stashes) and meta the removed stashes and, if needed, the row order.
+    Returns None if the snapshots cannot be delta encoded (other columns or dtypes, duplicate stashes);
+    a full snapshot should be written then.
+    """
+    if list(prev.columns) != list(cur.columns) or not prev.dtypes.equals(cur.dtypes):
+        return None
+    if prev["stash"].duplicated().any() or cur["stash"].duplicated().any():
+        return None
+
+    prev_i = prev.set_index("stash")
+    cur_i = cur.set_index("stash")
+    common = cur_i.index[cur_i.index.isin(prev_i.index)]
+    added = cur_i.index[~cur_i.index.isin(prev_i.index)]
+    removed = prev_i.index[~prev_i.index.isin(cur_i.index)]
+
+    changed_rows = np.zeros(len(common), dtype=bool)
+    changed_cols = []
+    for col in cur_i.columns:
+        diff = ~_same_cells(prev_i.loc[common, col], cur_i.loc[common, col])
+        if diff.any():
+            changed_rows |= diff
+            changed_cols.append(col)
+    if len(added) > 0:
+        changed_cols = list(cur_i.columns)
+
+    rows = common[changed_rows].append(added)
+    delta = cur_i.loc[rows, changed_cols].reset_index()
+
+    meta = {"removed": removed.tolist()}
+    expected_order = prev_i.index.drop(removed).append(added)
+    if not expected_order.equals(cur_i.index):
+        meta["order"] = cur_i.index.tolist()
+    return delta, meta
+
+
+def apply_delta(prev, delta, meta):
+    """
+    Rebuild a snapshot from the previous snapshot and a delta made by make_delta.
+    """
+    prev_i = prev.set_index("stash").drop(index=meta["removed"])
+    delta_i = delta.set_index("stash")
+    is_update = delta_i.index.isin(prev_i.index)
+    updates = delta_i[is_update]
+    added = delta_i[~is_update]
+
+    rows = prev_i.loc[updates.index].assign(**{col: updates[col] for col in updates.columns})
+    parts = [prev_i.drop(index=updates.index), rows]
+    if len(added) > 0:
+        parts.append(added[prev_i.columns])
+    cur = pd.concat([p for p in parts if len(p) > 0])
+
+    order = meta.get("order")
+    if order is None:
+        order = prev_i.index.append(added.index)
+    return cur.loc[order].reset_index()[prev.columns]
+
+
+def _write_delta(delta, meta, path):
+    table = pa.Table.from_pandas(delta, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[DELTA_META_KEY] = json.dumps(meta).encode()
+    feather.write_feather(table.replace_schema_metadata(metadata), path)
+
+
+def _read_delta(path):
+    table = feather.read_table(path)
+    meta = json.loads(table.schema.metadata[DELTA_META_KEY])
+    return table.to_pandas(), meta
+
+
+def write_snapshot(json_dir, datetime, df, delta=False, keyframe_every=24):
+    """
+    Write a dumped snapshot and register it in the manifest.
+
+    With delta=True only the changes w.r.t. the previous dump are written (as <datetime>.delta.arrow),
+    except for every keyframe_every-th dump which is written in full (as <datetime>.feather).
+    """
+    manifest = read_snapshot_manifest(json_dir)
+    if delta and not manifest.empty:
+        # compare in the representation that the reader gets back from disk
+        df = pa.Table.from_pandas(df, preserve_index=False).to_pandas()
+        full_pos = np.flatnonzero(manifest["kind"].values == "full")
+        since_keyframe = len(manifest) - full_pos[-1] if len(full_pos) > 0 else keyframe_every
+        if since_keyframe < keyframe_every:
+            prev = read_snapshot(json_dir, manifest["datetime"].iloc[-1], manifest)
+            encoded = make_delta(prev, df)
+            if encoded is not None:
+                file_name = f"{datetime}.delta.arrow"
+                _write_delta(*encoded, json_dir / file_name)
+                return register_snapshot(json_dir, datetime, file_name, kind="delta")
+
+    file_name = f"{datetime}.feather"
+    df.to_feather(json_dir / file_name)
+    return register_snapshot(json_dir, datetime, file_name)
+
+
+def iter_snapshots(json_dir, manifest, wanted):
+    """
+    Yield (datetime, snapshot) for the dump times in wanted, in the order of the manifest.
+
+    Delta snapshots are rebuilt from their keyframe. Each keyframe segment of the manifest is read
+    at most once and only up to the last wanted dump in it.
+    """
+    manifest = manifest.reset_index(drop=True)
+    is_wanted = manifest["datetime"].isin(wanted).values
+    segment = np.cumsum(manifest["kind"].values == "full")
+    for seg in np.unique(segment[is_wanted]):
+        pos = np.flatnonzero(segment == seg)
+        if seg == 0:
+            raise ValueError(f"Delta snapshots in {json_dir} without a preceding full snapshot.")
+        last = pos[is_wanted[pos]].max()
+        cur = None
+        for i in pos[pos <= last]:
+            datetime, file_name = manifest.at[i, "datetime"], manifest.at[i, "file"]
+            if manifest.at[i, "kind"] == "full":
+                cur = pd.read_feather(json_dir / file_name)
+            else:
+                cur = apply_delta(cur, *_read_delta(json_dir / file_name))
+            if is_wanted[i]:
+                yield datetime, cur
+
+
+def read_snapshot(json_dir, datetime, manifest=None):
+    """
+    Rebuild the snapshot dumped at datetime (full or delta encoded).
+    """
+    if manifest is None:
+        manifest = read_snapshot_manifest(json_dir)
+    for _, df in iter_snapshots(json_dir, manifest, [datetime]):
+        return df
+    raise FileNotFoundError(f"No snapshot for {datetime} in {json_dir}")
+
+
+def _with_dump_datetime(df, datetime):
+    df = df.copy()
+    df['dump.datetime'] = pd.to_datetime(datetime, unit='s')
+    return df.reset_index(drop=True)
+
+
+def _dump_timestamps(df):
+    """
+    Unix time (sec) of the dump.datetime column, independent of the datetime resolution of pandas.
+    """
+    return (df['dump.datetime'] - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
+
+def read_1kv_snapshots(json_dir, store_file, oldest_datetime=-1):
+    """
+    Incremental version of read_1kv_json.
+
+    The consolidated frame of all snapshots is kept in store_file. Each call only reads the snapshots
+    from the manifest that are not yet in store_file and drops the rows older than oldest_datetime (if not -1).
+    The result (and store_file) is identical to read_1kv_json up to the order of the rows.
+
+    With store_file None, nothing is persisted and the full history (since oldest_datetime) is rebuilt.
+    """
+    manifest = read_snapshot_manifest(json_dir)
+
+    changed = False
+    if store_file is not None and Path.exists(store_file):
+        df_store = pd.read_feather(store_file)
+        store_times = _dump_timestamps(df_store)
+        keep = store_times >= oldest_datetime
+        if not keep.all():
+            df_store = df_store[keep]
+            changed = True
+        done = set(store_times[keep].unique())
+    else:
+        df_store = None
+        done = set()
+
+    df_s = [] if df_store is None else [df_store]
+    times = manifest["datetime"]
+    wanted = times[(times >= oldest_datetime) & ~times.isin(list(done))]
+    for datetime, df in iter_snapshots(json_dir, manifest, wanted):
+        df = _with_dump_datetime(df, datetime)
+        df['score.datetime'] = pd.to_datetime(df['score.updated'], unit='ms')
+        df_s.append(df)
+        changed = True
+
+    df_all = pd.concat(df_s).reset_index(drop=True)
+    if changed and store_file is not None:
+        _write_atomic(df_all, store_file)
+    return df_all
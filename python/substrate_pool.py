@@ -0,0 +1,63 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Shared connections to the kusama and polkadot nodes, used by all scripts.
+
+One SubstrateInterface per chain is kept alive for the lifetime of the process, so the websocket
+handshake and the runtime metadata download happen once instead of on every query. The metadata
+is cached by SubstrateInterface itself per runtime version. ActiveEra is cached for a short time
+since several stages ask for it in the same cycle.
+"""
+
+import logging
+import time
+from substrateinterface import SubstrateInterface
+
+# TODO put in .env
+RPC_URLS = {"kusama": "wss://rpc.ibp.network/kusama",
+            "polkadot": "wss://rpc.ibp.network/polkadot"}
+# An era lasts hours, so a few minutes of caching is safe
+ACTIVE_ERA_TTL = 5*60
+
+_connections = {}
+_active_era = {}
+
+
+def rpc_url(chain):
+    if chain not in RPC_URLS:
+        raise ValueError("Unsupported chain. Use 'polkadot' or 'kusama'.")
+    return RPC_URLS[chain]
+
+
+def get_substrate(chain):
+    """
+    The kept-alive SubstrateInterface of chain. A closed websocket is reconnected.
+    """
+    substrate = _connections.get(chain)
+    if substrate is None:
+        logging.info(f"Connecting to {rpc_url(chain)}")
+        substrate = SubstrateInterface(url=rpc_url(chain), type_registry_preset=chain)
+        _connections[chain] = substrate
+    elif substrate.websocket is None or not substrate.websocket.connected:
+        logging.info(f"Reconnecting to {rpc_url(chain)}")
+        substrate.connect_websocket()
+    return substrate
+
+
+def query_active_era(chain, ttl=ACTIVE_ERA_TTL):
+    """
+    (index, start) of Staking.ActiveEra, cached for ttl seconds. Start is in ms.
+    """
+    cached = _active_era.get(chain)
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    result = get_substrate(chain).query(module='Staking', storage_function='ActiveEra').value
+    _active_era[chain] = (time.monotonic(), (result['index'], result['start']))
+    return result['index'], result['start']
+
+
+def close_connections():
+    for substrate in _connections.values():
+        substrate.close()
+    _connections.clear()
+    _active_era.clear()
@@ -0,0 +1,198 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Tests of rpc_fetch.py against a local stub websocket JSON-RPC server (no live node needed).
+
+cd python
+python -m pytest -q test_rpc_fetch.py
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+import websockets
+from substrateinterface.utils.hasher import xxh128, two_x64_concat
+from substrateinterface.utils.ss58 import ss58_encode
+
+from rpc_fetch import AsyncRpcClient, RpcError, fetch_active_validators
+
+SS58_FORMAT = 2
+
+
+class StubStorageKey:
+    """Storage key of Staking.ErasStakersOverview for one era, as built by SubstrateInterface."""
+    def __init__(self, era):
+        self.prefix = "0x" + (xxh128(b"Staking") + xxh128(b"ErasStakersOverview")
+                              + two_x64_concat(era.to_bytes(4, "little"))).hex()
+
+    def to_hex(self):
+        return self.prefix
+
+
+class StubSubstrate:
+    """The part of SubstrateInterface used by fetch_active_validators: storage keys without metadata."""
+    ss58_format = SS58_FORMAT
+
+    def create_storage_key(self, pallet, storage_function, params):
+        assert (pallet, storage_function) == ("Staking", "ErasStakersOverview")
+        return StubStorageKey(params[0])
+
+
+def stakers_keys(eras, n_validators):
+    """The storage keys (double map era, account with Twox64Concat) and the expected result of fetch_active_validators."""
+    keys = []
+    expected = {}
+    for era in eras:
+        accounts = [bytes([era % 256, i]) + bytes(30) for i in range(n_validators)]
+        keys += [StubStorageKey(era).to_hex() + two_x64_concat(account).hex() for account in accounts]
+        expected[era] = sorted(ss58_encode(account.hex(), SS58_FORMAT) for account in accounts)
+    return sorted(keys), expected
+
+
+class StubNode:
+    """
+    Websocket JSON-RPC server that answers state_getKeysPaged over fixed keys after a delay. Records the
+    number of requests in flight and the arrival times. The first errors requests get an error, the first
+    drops requests drop the connection (no close handshake).
+    """
+    def __init__(self, keys, delay=0.02, errors=0, drops=0):
+        self.keys = keys
+        self.delay = delay
+        self.errors = errors
+        self.drops = drops
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.arrivals = []
+        self.connections = 0
+
+    def keys_paged(self, prefix, count, start_key):
+        return [k for k in self.keys if k.startswith(prefix) and k > start_key][:count]
+
+    async def answer(self, ws, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        if self.errors > 0:
+            self.errors -= 1
+            answer = {"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32000, "message": "busy"}}
+        else:
+            answer = {"jsonrpc": "2.0", "id": request["id"], "result": self.keys_paged(*request["params"])}
+        try:
+            await ws.send(json.dumps(answer))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def handler(self, ws):
+        self.connections += 1
+        tasks = set()
+        async for message in ws:
+            self.arrivals.append(time.monotonic())
+            if self.drops > 0:
+                self.drops -= 1
+                ws.transport.abort()
+                return
+            task = asyncio.create_task(self.answer(ws, json.loads(message)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+
+def run_fetch(node, eras, page_size=4, **client_kwargs):
+    async def main():
+        async with websockets.serve(node.handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with AsyncRpcClient(f"ws://127.0.0.1:{port}", **client_kwargs) as client:
+                t1 = time.monotonic()
+                result = await fetch_active_validators(client, StubSubstrate(), eras, page_size=page_size)
+                return result, time.monotonic() - t1
+    return asyncio.run(main())
+
+
+def test_fetch_active_validators_pages():
+    eras = list(range(100, 106))
+    keys, expected = stakers_keys(eras, 10)
+    result, _ = run_fetch(StubNode(keys), eras, rate_limit=None)
+    assert {era: sorted(v) for era, v in result.items()} == expected
+
+
+def test_in_flight_bound():
+    eras = list(range(100, 120))
+    keys, expected = stakers_keys(eras, 3)
+    node = StubNode(keys, delay=0.05)
+    result, _ = run_fetch(node, eras, max_in_flight=3, rate_limit=None)
+    assert node.max_in_flight == 3
+    assert {era: sorted(v) for era, v in result.items()} == expected
+
+
+def test_rate_limit():
+    eras = list(range(100, 110))
+    keys, _ = stakers_keys(eras, 3)
+    node = StubNode(keys, delay=0.0)
+    run_fetch(node, eras, max_in_flight=8, rate_limit=50.0)
+    # 10 requests at most 50 per sec: at least 9 intervals of 20 ms (some slack for the clock of the loop)
+    assert len(node.arrivals) == 10
+    assert node.arrivals[-1] - node.arrivals[0] >= 9 / 50.0 * 0.9
+
+
+def test_retry_with_backoff():
+    eras = [100]
+    keys, expected = stakers_keys(eras, 3)
+    node = StubNode(keys, errors=2)
+    result, secs = run_fetch(node, eras, rate_limit=None, retries=2, backoff=0.1)
+    assert sorted(result[100]) == expected[100]
+    # waits of at least 0.1 and 0.2 sec before the two retries
+    assert secs >= 0.3
+    assert len(node.arrivals) == 3
+
+
+def test_retries_exhausted():
+    eras = [100]
+    keys, _ = stakers_keys(eras, 3)
+    with pytest.raises(RpcError):
+        run_fetch(StubNode(keys, errors=3), eras, rate_limit=None, retries=2, backoff=0.01)
+
+
+def test_reconnect_after_dropped_connection():
+    eras = list(range(100, 104))
+    keys, expected = stakers_keys(eras, 3)
+    node = StubNode(keys, drops=1)
+    result, _ = run_fetch(node, eras, max_in_flight=4, rate_limit=None, retries=3, backoff=0.01)
+    assert {era: sorted(v) for era, v in result.items()} == expected
+    # the request on the dropped connection (and the others in flight on it) went over a new connection
+    assert node.connections == 2
+
+
+class LateEnd:
+    """A connection whose messages end late: when it is closed, the iteration waits until it is cancelled."""
+    def __init__(self, ws):
+        self.ws = ws
+
+    async def __aiter__(self):
+        async for message in self.ws:
+            yield message
+        await asyncio.Event().wait()
+
+
+class LateReaderClient(AsyncRpcClient):
+    """Client whose reader does not notice (nor forget) a dropped connection."""
+    async def _read(self, ws, pending):
+        await super()._read(LateEnd(ws), pending)
+
+
+def test_retry_does_not_reuse_dead_connection():
+    eras = [100]
+    keys, expected = stakers_keys(eras, 3)
+    node = StubNode(keys, drops=1)
+
+    async def main():
+        async with websockets.serve(node.handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with LateReaderClient(f"ws://127.0.0.1:{port}", rate_limit=None, retries=3, backoff=0.01, timeout=0.2) as client:
+                return await fetch_active_validators(client, StubSubstrate(), eras, page_size=4)
+
+    # the first request times out, the retry fails on the dead connection and then goes over a new one
+    result = asyncio.run(main())
+    assert sorted(result[100]) == expected[100]
+    assert node.connections == 2
@@ -0,0 +1,190 @@
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+Delta upload of the built website (doks/public) to a destination.
+
+The manifest (a json file) holds, for each file at the destination, its size, modification time and
+content hash at the time it was uploaded. An upload hashes the local files (the hash of a file whose
+size and modification time did not change is taken from the manifest), uploads only the new and changed
+files, deletes the files that are gone and then updates the manifest. Without a manifest, the destination
+is synced completely once.
+
+A destination has the methods put(local_root, paths), delete(paths) and sync(local_root, paths), with paths
+relative to local_root (posix). put and delete return the paths that succeeded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import copy2
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(manifest_file):
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+    tmp = manifest_file.with_name(manifest_file.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_file)
+
+
+def scan_files(local_root, manifest=None, exclude=None):
+    """
+    All files under local_root as a dict path -> [size, mtime_ns, hash], with paths relative to local_root.
+    exclude(path) returns True for a file that is not uploaded.
+    """
+    manifest = manifest or {}
+    files = {}
+    for root, dirs, names in os.walk(local_root):
+        for name in names:
+            full = Path(root) / name
+            path = full.relative_to(local_root).as_posix()
+            if exclude is not None and exclude(path):
+                continue
+            st = full.stat()
+            old = manifest.get(path)
+            if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                files[path] = old
+            else:
+                files[path] = [st.st_size, st.st_mtime_ns, file_hash(full)]
+    return files
+
+
+def plan_upload(files, manifest):
+    """
+    The paths to upload (new or other content) and to delete (no longer a local file), both sorted.
+    """
+    changed = sorted(p for p, entry in files.items() if p not in manifest or manifest[p][2] != entry[2])
+    deleted = sorted(p for p in manifest if p not in files)
+    return changed, deleted
+
+
+def upload(local_root, destination, manifest_file, exclude=None):
+    """
+    Upload the changes of local_root since the last upload to destination. Returns True if all succeeded.
+    Files that failed are not in the manifest afterwards, so they are uploaded again the next time.
+    """
+    t1 = time.time()
+    manifest = read_manifest(manifest_file)
+    files = scan_files(local_root, manifest, exclude)
+    if manifest is None:
+        logging.info(f"   No upload manifest, syncing all {len(files)} files.")
+        ok = destination.sync(local_root, sorted(files))
+        if ok:
+            write_manifest(manifest_file, files)
+        logging.info(f"   Sync done in {time.time()-t1:.1f} sec.")
+        return ok
+
+    changed, deleted = plan_upload(files, manifest)
+    logging.info(f"   {len(changed)} files to upload and {len(deleted)} to delete (of {len(files)}), "
+                 f"found in {time.time()-t1:.1f} sec.")
+    done = set(destination.put(local_root, changed)) if changed else set()
+    gone = set(destination.delete(deleted)) if deleted else set()
+
+    # the manifest describes the destination: new entries for what was uploaded, old ones for what failed
+    new_manifest = {p: entry for p, entry in manifest.items() if p not in gone}
+    for p in changed:
+        if p in done:
+            new_manifest[p] = files[p]
+        else:
+            new_manifest.pop(p, None)
+    write_manifest(manifest_file, new_manifest)
+    ok = len(done) == len(changed) and len(gone) == len(deleted)
+    logging.info(f"   Upload {'done' if ok else 'incomplete'} in {time.time()-t1:.1f} sec.")
+    return ok
+
+
+class LocalDirDestination:
+    """
+    A local directory as destination (e.g. a directory served by a web server, or for tests).
+    """
+    def __init__(self, root, transfers=8):
+        self.root = Path(root)
+        self.transfers = transfers
+
+    def _put_one(self, local_root, path):
+        dst = self.root / path
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f".{dst.name}.tmp")
+        copy2(local_root / path, tmp)
+        os.replace(tmp, dst)
+        return path
+
+    def put(self, local_root, paths):
+        done = []
+        with ThreadPoolExecutor(max_workers=self.transfers) as executor:
+            futures = [executor.submit(self._put_one, local_root, p) for p in paths]
+            for future in futures:
+                try:
+                    done.append(future.result())
+                except OSError as e:
+                    logging.info(f"   Upload failed: {e}")
+        return done
+
+    def delete(self, paths):
+        for p in paths:
+            (self.root / p).unlink(missing_ok=True)
+        return list(paths)
+
+    def sync(self, local_root, paths):
+        keep = set(paths)
+        if self.root.exists():
+            old = [f.relative_to(self.root).as_posix() for f in self.root.rglob("*") if f.is_file()]
+            self.delete([p for p in old if p not in keep])
+        return len(self.put(local_root, paths)) == len(paths)
+
+
+class RcloneDestination:
+    """
+    An rclone remote (e.g. "InsightWebsite:./", configured before) as destination. The paths are passed to
+    rclone as a list (--files-from), so rclone neither lists nor compares the other files.
+    """
+    def __init__(self, remote, transfers=16):
+        self.remote = remote
+        self.transfers = transfers
+
+    def _run(self, args, paths, cwd=None):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("\n".join(paths) + "\n")
+            f.flush()
+            my_env = os.environ.copy()
+            my_env["PATH"] = "/usr/bin:" + my_env["PATH"]
+            cmd = ["rclone"] + args + ["--files-from", f.name, "--transfers", f"{self.transfers}",
+                                       "--checkers", f"{self.transfers}", "--stats-log-level", "NOTICE", "--stats", "5m"]
+            out = subprocess.run(cmd, capture_output=True, cwd=cwd, env=my_env)
+        if out.returncode != 0:
+            logging.info(f"   rclone {args[0]} failed.")
+            logging.info(out.stderr)
+        return out.returncode == 0
+
+    def put(self, local_root, paths):
+        # --no-traverse: only the listed files are looked up at the remote
+        ok = self._run(["copy", "--no-traverse", f"{local_root}", self.remote], paths)
+        return list(paths) if ok else []
+
+    def delete(self, paths):
+        ok = self._run(["delete", self.remote], paths)
+        return list(paths) if ok else []
+
+    def sync(self, local_root, paths):
+        # everything that is not listed is removed from the remote
+        return self._run(["sync", "--delete-excluded", f"{local_root}", self.remote], paths)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Copyright 2022-23 https://www.math-crypto.com -- GNU Affero General Public License v3.0
+
+"""
+What-if simulation of the 1kv ranking under other score weights and quantile bounds.
+
+The score of a validator is the sum over the score fields (components) of a scaled value between 0 and 1
+times the weight of the field (see scores_1kv_config). The scaled values form a (validator x component)
+matrix: the reported scores divided by the current weights, or recomputed from the 1kv inputs with other
+quantile bounds (see score_components). The aggregate scores of many weight configurations are then one
+matrix product, and the rankings one rank over the columns.
+
+A scenario is a dict with a name, weights (field -> weight, the other fields keep the current weight) and
+bounds (field -> [lower, upper] quantile). Scenarios with the same bounds share their matrix.
+
+    python what_if.py kusama scenarios.json
+
+with scenarios.json e.g. [{"name": "no bonded", "weights": {"bonded": 0}}, {"name": "wide bonded", "bounds": {"bonded": [0.01, 0.99]}}]
+writes the rank shifts of each validator and a summary per scenario to info/<chain>/.
+"""
+
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scores_1kv import *
+
+PATH_INFO = Path.cwd() / "../info"
+
+# Not components: the aggregate and total are sums, the randomness is a random factor
+NOT_COMPONENTS = ["aggregate", "randomness", "total"]
+
+
+def component_fields(chain):
+    return [f for f in score_weights[chain] if f not in NOT_COMPONENTS]
+
+
+def component_matrix(chain, last_1kv, bounds=None):
+    """
+    The (validator x component) matrix of the scaled scores (between 0 and 1). The reported scores divided
+    by the current weights; the fields in bounds (and fields without weight) are recomputed from the inputs
+    (a missing input counts as 0).
+    """
+    fields = component_fields(chain)
+    weights = np.array([score_weights[chain][f] for f in fields])
+    reported = last_1kv[[f"score.{f}" for f in fields]].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        matrix = np.where(weights > 0, reported / weights, np.nan)
+
+    bounds = bounds or {}
+    unknown = set(bounds).difference(fields)
+    if unknown:
+        raise ValueError(f"Unknown score fields in bounds: {', '.join(sorted(unknown))}")
+    recompute = [j for j, f in enumerate(fields) if f in bounds or weights[j] <= 0]
+    if recompute:
+        recomputed = score_components(chain, last_1kv, bounds)
+        missing = [f for f in bounds if f not in recomputed.columns]
+        if missing:
+            raise ValueError(f"No inputs in last_1kv to recompute {', '.join(missing)} with other bounds")
+        for j in recompute:
+            if fields[j] in recomputed.columns:
+                matrix[:, j] = recomputed[fields[j]].to_numpy()
+    return np.nan_to_num(matrix), fields
+
+
+def weight_matrix(chain, scenarios, fields):
+    """
+    The (component x scenario) matrix of the weights of the scenarios.
+    """
+    weights = np.tile(np.array([score_weights[chain][f] for f in fields], dtype=float)[:, None], (1, len(scenarios)))
+    for k, scenario in enumerate(scenarios):
+        for f, w in scenario.get("weights", {}).items():
+            if f not in fields:
+                raise ValueError(f"Unknown score field {f} in the weights of {scenario.get('name', k)}")
+            weights[fields.index(f), k] = float(w)
+    return weights
+
+
+def simulate(chain, last_1kv, scenarios):
+    """
+    The aggregate score and rank of each validator under each scenario, and the shift of its rank from the
+    ranking with the current weights and bounds (positive is a better rank).
+
+    Returns (aggregate, rank, shift), dataframes with index stash and one column per scenario name (and
+    "current" in aggregate and rank).
+    """
+    names = [scenario.get("name", f"scenario {k}") for k, scenario in enumerate(scenarios)]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the scenarios are not unique")
+
+    current, fields = component_matrix(chain, last_1kv)
+    weights = weight_matrix(chain, scenarios, fields)
+    aggregate = np.empty((len(last_1kv), len(scenarios) + 1))
+    aggregate[:, 0] = current @ np.array([score_weights[chain][f] for f in fields])
+
+    # one matrix per set of bounds, one product for all scenarios with it
+    groups = {}
+    for k, scenario in enumerate(scenarios):
+        key = json.dumps({f: list(map(float, b)) for f, b in scenario.get("bounds", {}).items()}, sort_keys=True)
+        groups.setdefault(key, []).append(k)
+    for key, ks in groups.items():
+        bounds = json.loads(key)
+        matrix = current if not bounds else component_matrix(chain, last_1kv, bounds)[0]
+        aggregate[:, np.array(ks) + 1] = matrix @ weights[:, ks]
+
+    aggregate = pd.DataFrame(aggregate, index=pd.Index(last_1kv["stash"], name="stash"), columns=["current"] + names)
+    rank = aggregate.rank(axis=0, ascending=False, method="min").astype(int)
+    shift = rank[names].rsub(rank["current"], axis=0)
+    return aggregate, rank, shift
+
+
+def summarize_shifts(shift, top=100, rank=None):
+    """
+    Per scenario: the number of validators with another rank, the mean and max absolute shift, and (with rank)
+    the number of validators that enter the top.
+    """
+    summary = pd.DataFrame({"changed": (shift != 0).sum(), "mean_abs_shift": shift.abs().mean(),
+                            "max_up": shift.max(), "max_down": -shift.min()})
+    if rank is not None:
+        in_top = rank[shift.columns].le(top)
+        summary[f"enter_top{top}"] = (in_top & ~rank["current"].le(top).to_numpy()[:, None]).sum()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank shifts of the 1kv validators under other score weights and quantile bounds.")
+    parser.add_argument("chain", choices=["kusama", "polkadot"])
+    parser.add_argument("scenarios", type=Path, help="json file with a list of scenarios (name, weights, bounds)")
+    parser.add_argument("--top", type=int, default=100, help="size of the top in the summary")
+    args = parser.parse_args()
+
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    last_1kv = pd.read_feather(PATH_INFO / args.chain / "last_info_1kv.feather")
+
+    t1 = time.time()
+    aggregate, rank, shift = simulate(args.chain, last_1kv, scenarios)
+    summary = summarize_shifts(shift, args.top, rank)
+    logging.info(f"Simulated {len(scenarios)} scenarios for {len(last_1kv)} validators in {time.time()-t1:.2f} sec.")
+
+    shifts = shift.copy()
+    shifts.insert(0, "rank", rank["current"])
+    shifts.insert(0, "name", last_1kv["name"].to_numpy())
+    shifts.sort_values("rank").to_csv(PATH_INFO / args.chain / "what_if_shifts.csv")
+    summary.to_csv(PATH_INFO / args.chain / "what_if_summary.csv")
+    print(summary.to_string())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -18,3 +18,6 @@ mkdir -p ../tmp/polkadot/
 mkdir -p ../web/kusama/
 mkdir -p ../web/polkadot/
 
+mkdir -p ../events/score
+mkdir -p ../events/website
+